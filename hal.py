@@ -1,20 +1,41 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import importlib
+import json
+import logging
+import sys
+import os
+
+# has to replace the hardware modules before anything imports them:
+import sim
+SIMULATED = sim.select(sys.argv, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'config.json'))
+
 import RPi.GPIO as gpio
 from lib.orientation import Orientation
 from lib.move import Move
 from lib.roofmount import RoofMount
+from lib.adc import ADC
 from lib.ir import IR
-from lib.ultrasonic import UltraSonic
+from lib.ultrasonic import UltraSonicArray
 
 from util.getch import *
 from util.tcp import TCP
+from util import scanframe
+from util.dispatch import Dispatcher, Request, CommandError, NUMBER
+from util.subscriptions import Subscriptions
+from util.metrics import registry
+from util import log
+from util.recorder import Recorder
+from util.sampler import Sampler
+from util import workers
 
-import json
-import sys
-import os
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('hal')
 
 
 class Hal:
@@ -22,24 +43,203 @@ class Hal:
         "hbridge": {"enabled": False},
         "roofmount": {"enabled": False},
         "orientation": {"enabled": False},
+        "ir": {"enabled": False},
+        "ultrasonic": {"enabled": False},
+        "stats": {"dumpIntervalSeconds": 0},
+        "recorder": {"enabled": False},
+        "sharedMemory": {"enabled": False},
+        "udp": {"enabled": False},
+        "workers": {"enabled": False},
     }
     _move = None
     _roofmount = None
     _orientation = None
+    _adc = None
+    _ir = {}
+    _ultrasonic = None
+    _player = None
+    _recorder = None
+    _sampler = None
+    _sinks = []
+    _udp = None
+    _workers = {}
 
-    def __init__(self, config):
-        print("Initializing Hardware Abstraction Layer...")
+    def __init__(self, config, replay=None):
+        '''replay: (path, speed) of a recording to serve instead of the
+        hardware'''
+        logger.info('Initializing Hardware Abstraction Layer...')
+        # several clients may be connected; one command drives at a time:
+        self._actuators = ThreadPoolExecutor(max_workers=1)
+        self.__register_commands()
         gpio.setmode(gpio.BOARD)
         self._config.update(config)
+        if replay is not None:
+            self.__replay_devices(*replay)
+        else:
+            self.__create_devices()
+        self._subscriptions = Subscriptions(self.__topics())
+        registry.gauge('subscriptions', self._subscriptions.count)
+        if self._config['stats'].get('dumpIntervalSeconds'):
+            threading.Thread(target=self.__dump_stats, daemon=True).start()
+        self.__start_telemetry(record=replay is None)
+
+    def __create_devices(self):
+        started = self.__start_workers()
         # controls:
         if self._config['hbridge'] and self._config['hbridge']['enabled']:
             self._move = Move()
-        if self._config['roofmount'] and self._config['roofmount']['enabled']:
-            self._roofmount = RoofMount(self._config['roofmount'])
+        if self.__enabled('roofmount'):
+            lidar = None
+            if 'i2c' in started and self.__lidar_config():
+                lidar = workers.LidarProxy(
+                    started['i2c'],
+                    self.__lidar_config()['updateRatePerSecond'])
+            self._roofmount = RoofMount(self._config['roofmount'], lidar)
         # orientation:
-        if self._config['orientation'] \
-                and self._config['orientation']['enabled']:
-            self.orientation = Orientation()
+        if self.__enabled('orientation'):
+            if 'i2c' in started:
+                self._orientation = workers.OrientationProxy(
+                    started['i2c'])
+            else:
+                self._orientation = Orientation(self._config['orientation'])
+        # ir distance sensors, sharing one adc:
+        if self.__enabled('ir'):
+            sensors = self._config['ir']['sensors']
+            adc_config = self.__adc_config()
+            if 'spi' in started:
+                self._adc = workers.ADCProxy(
+                    started['spi'], adc_config['channels'])
+            else:
+                self._adc = ADC(adc_config)
+                self._adc.start()
+            self._ir = {name: IR(channel, self._adc)
+                        for name, channel in sensors.items()}
+        if self.__enabled('ultrasonic'):
+            if 'ultrasonic' in started:
+                self._ultrasonic = workers.UltraSonicProxy(
+                    started['ultrasonic'],
+                    self._config['ultrasonic']['sensors'])
+            else:
+                self._ultrasonic = UltraSonicArray(
+                    self._config['ultrasonic'])
+                self._ultrasonic.start()
+
+    def __enabled(self, name):
+        return bool(self._config[name] and self._config[name]['enabled'])
+
+    def __lidar_config(self):
+        lidar = self._config['roofmount'].get('lidar')
+        if lidar and lidar.get('enabled', True):
+            return lidar
+        return None
+
+    def __adc_config(self):
+        adc_config = dict(self._config['ir'].get('adc', {}))
+        adc_config['channels'] = sorted(
+            set(self._config['ir']['sensors'].values()))
+        return adc_config
+
+    def __start_workers(self):
+        '''One process per bus for the configured domains (see
+        util/workers.py). Started before anything else opens a device,
+        so the children do not inherit open handles.'''
+        config = self._config['workers']
+        if not config.get('enabled'):
+            return {}
+        domains = {}
+        i2c = {}
+        if self.__enabled('roofmount') and self.__lidar_config():
+            i2c['lidar'] = self.__lidar_config()
+        if self.__enabled('orientation'):
+            i2c['orientation'] = self._config['orientation']
+        if i2c:
+            domains['i2c'] = i2c
+        if self.__enabled('ir'):
+            domains['spi'] = {'adc': self.__adc_config()}
+        if self.__enabled('ultrasonic'):
+            domains['ultrasonic'] = {
+                'ultrasonic': self._config['ultrasonic']}
+        self._workers = {}
+        try:
+            for domain in config.get('domains', workers.DOMAINS):
+                if domain in domains:
+                    self._workers[domain] = workers.Worker(
+                        domain, domains[domain],
+                        config.get('pollRatePerSecond', 500))
+        except RuntimeError:
+            for worker in self._workers.values():
+                worker.close()
+            raise
+        return self._workers
+
+    def __replay_devices(self, path, speed):
+        from util import replay
+        self._player, devices = replay.devices(path, speed)
+        self._roofmount = devices.get('roofmount')
+        self._orientation = devices.get('orientation')
+        self._ir = devices.get('ir', {})
+        self._ultrasonic = devices.get('ultrasonic')
+
+    def __start_telemetry(self, record):
+        '''Pass every sensor sample and scan reading to the configured
+        sinks: the recorder, the shared memory rings and UDP.'''
+        sinks = []
+        rates = []
+        if record and self._config['recorder'].get('enabled'):
+            sinks.append(self.__recorder())
+            rates.append(self._config['recorder'].get(
+                'pollRatePerSecond', 100))
+        if self._config['sharedMemory'].get('enabled'):
+            from util.shm import SharedTelemetry
+            config = self._config['sharedMemory']
+            sinks.append(SharedTelemetry(config.get('prefix', 'hal'),
+                                         config.get('capacity', 4096)))
+            rates.append(config.get('pollRatePerSecond', 500))
+        if self._config['udp'].get('enabled'):
+            from util.udp import UdpTelemetry
+            self._udp = UdpTelemetry(self._config['udp'])
+            sinks.append(self._udp)
+            rates.append(self._config['udp'].get('pollRatePerSecond', 500))
+        self._sinks = sinks
+        if sinks:
+            self._sampler = Sampler(
+                sinks, max(rates), self._roofmount, self._orientation,
+                self._ir, self._ultrasonic)
+            self._sampler.start()
+
+    def __recorder(self):
+        '''Records every sensor sample and executed command'''
+        config = self._config['recorder']
+        path = time.strftime(config.get('path', 'recordings/%Y%m%d-%H%M%S'))
+        metadata = {
+            'devices': [name for name, device in (
+                ('roofmount', self._roofmount),
+                ('orientation', self._orientation)) if device is not None],
+            'channels': {
+                'ir': sorted(self._ir),
+                'ultrasonic': sorted(self._ultrasonic._sensors)
+                if self._ultrasonic is not None else [],
+            },
+        }
+        if self._roofmount is not None:
+            metadata['stepsPerRevolution'] = \
+                self._roofmount._stepper._stepsPerRevolution
+            metadata['offset'] = self._config['roofmount'].get(
+                'lidar', {}).get('offset', (0.0, 0.0, 0.0))
+        self._recorder = Recorder(path, metadata,
+                                  flush_interval=config.get(
+                                      'flushIntervalSeconds', 1.0))
+        return self._recorder
+
+    def close(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+        for sink in self._sinks:
+            sink.close()
+        if self._player is not None:
+            self._player.stop()
+        for worker in self._workers.values():
+            worker.close()
 
     def __del__(self):
         print("done")
@@ -49,19 +249,64 @@ class Hal:
         r = {}
         if self._roofmount is not None:
             r.update(self._roofmount.get_readings())
+        if self._ir:
+            r['ir'] = self.__ir_readings()
+        if self._ultrasonic is not None:
+            r['ultrasonic'] = self.__ultrasonic_readings()
         r['timestamp'] = time.time()
-        return json.dumps(r)
+        return r
+
+    def __ir_readings(self):
+        return {name: ir.distance() for name, ir in self._ir.items()}
+
+    def __ultrasonic_readings(self):
+        r = {}
+        for name in self._ultrasonic._sensors:
+            latest = self._ultrasonic.latest(name)
+            r[name] = latest[0] if latest else None
+        return r
+
+    def __topics(self):
+        '''Telemetry that clients can subscribe to'''
+        topics = {}
+        if self._roofmount is not None:
+            topics['lidar'] = self._roofmount.lidar_reading
+            topics['roofmount'] = self._roofmount.position
+        if self._orientation is not None:
+            topics['orientation'] = self.get_orientation
+        if self._ir:
+            topics['ir'] = self.__ir_readings
+        if self._ultrasonic is not None:
+            topics['ultrasonic'] = self.__ultrasonic_readings
+        return topics
 
     def get_orientation(self):
         r = {}
-        if self.orientation is not None:
-            yaw, roll, pitch = self.orientation.euler()
+        if self._orientation is None:
+            return r
+        if not self._orientation.running():
+            yaw, roll, pitch = self._orientation.euler()
             r = {
                 'yaw': yaw,
                 'roll': roll,
                 'pitch': pitch
             }
-        return json.dumps(r)
+            return r
+        latest = self._orientation.latest()
+        if 'euler' in latest:
+            (yaw, roll, pitch), r['timestamp'] = latest['euler']
+            r.update({'yaw': yaw, 'roll': roll, 'pitch': pitch})
+        for name in ('quaternion', 'gyro', 'calibration'):
+            if name in latest:
+                value, t = latest[name]
+                r[name] = {'value': value, 'timestamp': t}
+        return r
+
+    def __dump_stats(self):
+        interval = self._config['stats']['dumpIntervalSeconds']
+        while True:
+            time.sleep(interval)
+            logger.info('Stats: %s', json.dumps(registry.snapshot()))
 
     def manual_control(self):
         print("Use w,a,s,d to move the vehicle. to exit")
@@ -69,7 +314,7 @@ class Hal:
         speed = 50
         step = 10
         while True:
-            print(self.get_readings())
+            print(json.dumps(self.get_readings()))
             print('Speed ', speed)
             k = getch()
             cmd = None
@@ -111,67 +356,263 @@ class Hal:
             elif k == "x":
                 break
             if cmd is not None:
-                self.__execute(cmd)
+                self.__execute(cmd, None, inline=True)
 
     def network_control(self):
         self.tcp = TCP()
         self.tcp.listen(self.__handler)
 
-    def __handler(self, payload):
-        print('Handling ' + payload)
+    def __handler(self, payload, conn):
+        logger.debug('Handling %s', payload)
         try:
             cmd = json.loads(payload)
-        except:
-            print("Could not decode json")
+        except ValueError:
+            logger.warning('Could not decode json: %s', payload)
             return
-        self.__execute(cmd)
+        self.__execute(cmd, conn)
 
-    def __execute(self, cmd):
-        # Drive controls:
-        if cmd['command'] == 'move' and cmd['direction'] == 'forward':
-            if self._move:
-                self._move.forward(cmd['time'], cmd['speed'])
-        elif cmd['command'] == 'move' and cmd['direction'] == 'backward':
-            if self._move:
-                self._move.backward(cmd['time'], cmd['speed'])
-        elif cmd['command'] == 'move' \
-                and cmd['direction'] == 'counter_clockwise':
-            if self._move:
-                self._move.counter_clockwise(
-                    cmd['time'], cmd['speed'])
-        elif cmd['command'] == 'move' and cmd['direction'] == 'clockwise':
-            if self._move:
-                self._move.clockwise(cmd['time'], cmd['speed'])
+    def __execute(self, cmd, conn, inline=False):
+        req = Request(cmd, conn)
+        try:
+            command, args = self._commands.lookup(cmd)
+        except CommandError as e:
+            registry.counter('command.rejected').add()
+            req.reply({'command': cmd.get('command') if isinstance(
+                cmd, dict) else None, 'error': str(e)})
+            return
+        if command.exclusive and not inline:
+            # hardware commands queue up in order; reads do not wait:
+            self._actuators.submit(self.__run, command, req, args)
+        else:
+            self.__run(command, req, args)
 
-        # View controls:
-        elif cmd['command'] == 'horizontal_position':
-            if self._roofmount:
-                self._roofmount.set_horizontal_position(cmd['position'])
-        elif cmd['command'] == 'vertical_position':
-            if self._roofmount:
-                self._roofmount.set_vertical_position(cmd['position'])
+    def __run(self, command, req, args):
+        if self._recorder is not None:
+            self._recorder.command(req.cmd)
+        timer = registry.histogram('command.' + command.name).time()
+        try:
+            with timer:
+                command.handler(req, **args)
+        except CommandError as e:
+            registry.counter('command.' + command.name + '.errors').add()
+            req.reply({'command': command.name, 'error': str(e)})
+        except Exception as e:
+            registry.counter('command.' + command.name + '.errors').add()
+            logger.exception('%s failed', command.name)
+            req.reply({'command': command.name, 'error': str(e)})
 
+    def __register_commands(self):
+        self._commands = Dispatcher()
+        register = self._commands.register
+        # Drive controls:
+        register('move', self.__move,
+                 required={'direction': str, 'time': NUMBER,
+                           'speed': NUMBER})
+        register('stop', self.__stop, exclusive=False)
+        register('get_motion', self.__get_motion, exclusive=False)
+        # View controls:
+        register('horizontal_position', self.__horizontal_position,
+                 required={'position': NUMBER})
+        register('vertical_position', self.__vertical_position,
+                 required={'position': NUMBER})
+        register('point', self.__point,
+                 required={'horizontal_position': NUMBER,
+                           'vertical_position': NUMBER})
         # Sensor controls:
-        elif cmd['command'] == 'get_orientation':
-            self.tcp.send(self.get_orientation())
-        elif cmd['command'] == 'get_readings':
-            self.tcp.send(self.get_readings())
-        elif cmd['command'] == 'horizontal_scan':
-            readings = self._roofmount.horizontal_scan(
-                cmd['vertical_position'],
-                cmd['resolution'],
-                lambda reading: self.tcp.send(json.dumps(reading)))
-            self.tcp.send(json.dumps(
-                '{"command": "horizontal_scan", "status": "complete"}'))
-
+        register('get_orientation', self.__get_orientation, exclusive=False)
+        register('get_readings', self.__get_readings, exclusive=False)
+        scan_options = {
+            'encoding': (str, 'json'),
+            'batch': (int, scanframe.DEFAULT_BATCH),
+            'resolution': (NUMBER, 1.0),
+        }
+        register('horizontal_scan', self.__horizontal_scan,
+                 required={'vertical_position': NUMBER},
+                 optional=dict(scan_options, mode=(str, 'step'),
+                               rate=(NUMBER, None)))
+        register('volume_scan', self.__volume_scan,
+                 required={'min_vertical_position': NUMBER,
+                           'max_vertical_position': NUMBER,
+                           'increment': NUMBER},
+                 optional=scan_options)
+        register('subscribe', self.__subscribe,
+                 required={'topic': str, 'rate': NUMBER},
+                 optional={'threshold': (NUMBER, None)},
+                 exclusive=False)
+        register('unsubscribe', self.__unsubscribe,
+                 optional={'topic': (str, None)},
+                 exclusive=False)
+        register('udp_telemetry', self.__udp_telemetry,
+                 optional={'port': (int, None)},
+                 exclusive=False)
+        register('get_stats', self.__get_stats, exclusive=False)
         # Syncronization controls:
-        elif cmd['command'] == 'isready':
-            self.tcp.send('{"status":"readyok"}')
+        # queued behind the hardware commands sent before it:
+        register('isready', self.__isready)
+
+    def __move(self, req, direction, time, speed):
+        if not self._move:
+            return
+        moves = {
+            'forward': self._move.forward,
+            'backward': self._move.backward,
+            'counter_clockwise': self._move.counter_clockwise,
+            'clockwise': self._move.clockwise,
+        }
+        if direction not in moves:
+            raise CommandError('unknown direction: ' + direction)
+        moves[direction](time, speed)
+
+    def __stop(self, req):
+        if self._move:
+            self._move.stop()
+
+    def __get_motion(self, req):
+        status = self._move.status() if self._move else None
+        req.reply({'command': 'get_motion', 'motion': status})
+
+    def __horizontal_position(self, req, position):
+        if self._roofmount:
+            self._roofmount.set_horizontal_position(position)
+
+    def __vertical_position(self, req, position):
+        if self._roofmount:
+            self._roofmount.set_vertical_position(position)
+
+    def __point(self, req, horizontal_position, vertical_position):
+        if self._roofmount:
+            self._roofmount.point(horizontal_position, vertical_position)
+
+    def __get_orientation(self, req):
+        req.reply(self.get_orientation())
+
+    def __get_readings(self, req):
+        req.reply(self.get_readings())
+
+    def __scan_stream(self, req, encoding, batch, vertical):
+        '''Callback for scan readings in the encoding the client asked for,
+        and a function to call when the scan is done.'''
+        frames = None
+        if encoding == 'binary' and req.conn is not None:
+            frames = scanframe.ScanFrameWriter(
+                req.send_bytes, vertical, batch)
+        elif encoding == 'points' and req.conn is not None:
+            # fail before the head starts turning, not at the first batch:
+            try:
+                importlib.import_module('lib.pointcloud')
+            except ImportError as e:
+                raise CommandError('points encoding unavailable: %s' % e)
+            frames = scanframe.PointFrameWriter(
+                req.send_bytes, vertical, self._roofmount.point_cloud, batch)
+        if frames is not None:
+            callback, done = frames.add, frames.flush
+        else:
+            callback, done = req.reply, lambda: None
+        if not self._sinks:
+            return callback, done
+        # pass the readings on as one scan:
+        scans = [(sink, sink.new_scan()) for sink in self._sinks]
+
+        def publish(reading):
+            for sink, scan_id in scans:
+                sink.scan(scan_id, reading)
+            callback(reading)
+
+        def end():
+            done()
+            for sink, scan_id in scans:
+                sink.scan_end(scan_id)
+        return publish, end
+
+    def __horizontal_scan(self, req, vertical_position, encoding, batch,
+                          resolution, mode, rate):
+        if self._roofmount is None:
+            raise CommandError('roofmount not enabled')
+        callback, done = self.__scan_stream(
+            req, encoding, batch, vertical_position)
+        try:
+            with registry.histogram('scan.' + mode).time():
+                if mode == 'continuous':
+                    self._roofmount.continuous_scan(
+                        vertical_position, rate, callback)
+                else:
+                    self._roofmount.horizontal_scan(
+                        vertical_position, resolution, callback)
+        finally:
+            # a failed scan still ends, so replay does not run it into
+            # the next one:
+            done()
+        req.reply({"command": "horizontal_scan", "status": "complete"})
+
+    def __volume_scan(self, req, min_vertical_position,
+                      max_vertical_position, increment, encoding, batch,
+                      resolution):
+        if self._roofmount is None:
+            raise CommandError('roofmount not enabled')
+        callback, done = self.__scan_stream(
+            req, encoding, batch, min_vertical_position)
+        try:
+            with registry.histogram('scan.volume').time():
+                self._roofmount.volume_scan(
+                    min_vertical_position, max_vertical_position, increment,
+                    resolution, callback)
+        finally:
+            done()
+        req.reply({"command": "volume_scan", "status": "complete"})
+
+    def __subscribe(self, req, topic, rate, threshold):
+        if req.conn is None:
+            raise CommandError('subscriptions need a connection')
+        try:
+            self._subscriptions.subscribe(req.conn, topic, rate, threshold)
+        except ValueError as e:
+            raise CommandError(str(e))
+        req.reply({'command': 'subscribe', 'topic': topic,
+                   'status': 'ok'})
+
+    def __unsubscribe(self, req, topic):
+        if req.conn is not None:
+            self._subscriptions.unsubscribe(req.conn, topic)
+        req.reply({'command': 'unsubscribe', 'topic': topic,
+                   'status': 'ok'})
+
+    def __udp_telemetry(self, req, port):
+        '''Send UDP telemetry to this client on port, or stop if no port
+        is given'''
+        if self._udp is None:
+            raise CommandError('udp telemetry not enabled')
+        if req.conn is None:
+            raise CommandError('udp telemetry needs a connection')
+        if port is None:
+            self._udp.remove(req.conn)
+        elif not 0 < port < 65536:
+            raise CommandError('bad argument: port')
+        else:
+            self._udp.add(req.conn, port)
+        req.reply({'command': 'udp_telemetry', 'port': port,
+                   'status': 'ok'})
+
+    def __get_stats(self, req):
+        req.reply({'command': 'get_stats', 'stats': registry.snapshot()})
+
+    def __isready(self, req):
+        req.reply({"status": "readyok"})
 
 
 if __name__ == "__main__":
     # check args:
-    if len(sys.argv) <= 1:
+    args = [arg for arg in sys.argv[1:] if arg != '--sim']
+    replay = None
+    if '--replay' in args:
+        # serve a recording, optionally sped up: --replay <path> [--speed n]
+        i = args.index('--replay')
+        replay = [args[i + 1], 1.0]
+        del args[i:i + 2]
+        if '--speed' in args:
+            i = args.index('--speed')
+            replay[1] = float(args[i + 1])
+            del args[i:i + 2]
+    if not args:
         print("Please specify --network or --manual")
         sys.exit(1)
 
@@ -184,13 +625,18 @@ if __name__ == "__main__":
     f = open('config.json')
     settings = json.load(f)
     f.close()
-    hal = Hal(settings)
-    if sys.argv[1] == '--network':
+    log.setup(settings.get('logging'))
+    hal = Hal(settings, replay)
+    if args[0] == '--network':
         hal.network_control()
-    elif sys.argv[1] == '--manual':
+    elif args[0] == '--manual':
         hal.manual_control()
-    elif sys.argv[1] == '--test':
-        print("todo")
+    elif args[0] == '--test':
+        # micro-benchmarks of the hot paths:
+        from util import bench
+        path = args[1] if len(args) > 1 else 'bench_results.json'
+        bench.run(hal, path, 'sim' if SIMULATED else 'hardware')
     else:
         print("unknown arguement")
+    hal.close()
     del(hal)
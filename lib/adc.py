@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+import Adafruit_GPIO.SPI as SPI
+import Adafruit_MCP3008
+
+from util.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+##########################################################################
+#  MCP3008 8-Channel 10-Bit ADC
+##########################################################################
+#  The SPI device is opened once. A background loop reads every configured
+#  channel in turn, takes the median of `oversample` conversions for each,
+#  and publishes the result with a timestamp.
+#
+class ADC:
+    CHANNELS = 8
+    MAX_VALUE = 1023
+
+    _config = {
+        'spi': {
+            'port': 0,
+            'device': 0
+        },
+        'channels': [2],
+        'oversample': 5,
+        'ratePerSecond': 200,
+    }
+
+    def __init__(self, config=None):
+        if config:
+            self._config.update(config)
+        self._mcp = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(
+            self._config['spi']['port'], self._config['spi']['device']))
+        self._channels = list(self._config['channels'])
+        for channel in self._channels:
+            if channel < 0 or channel >= self.CHANNELS:
+                raise ValueError('ADC channel must be between 0 and 7')
+        self._oversample = max(1, self._config['oversample'])
+        self._latest = {}
+        self._read_time = registry.histogram('adc.read')
+        self._transactions = registry.counter('adc.transactions')
+        self._thread = None
+        self._running = False
+
+    def read(self, channel):
+        '''Median of `oversample` conversions of one channel'''
+        start = time.perf_counter()
+        samples = sorted(self._mcp.read_adc(channel)
+                         for i in range(self._oversample))
+        self._read_time.record(time.perf_counter() - start)
+        self._transactions.add(self._oversample)
+        return samples[len(samples) // 2]
+
+    def scan(self):
+        '''Read every configured channel once and publish the results'''
+        for channel in self._channels:
+            self._latest[channel] = (self.read(channel), time.time())
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.__sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._running
+
+    def __sample(self):
+        period = 1.0 / self._config['ratePerSecond']
+        next_scan = time.time()
+        while self._running:
+            try:
+                self.scan()
+            except OSError as e:
+                logger.warning('ADC read failed: %s', e)
+            next_scan += period
+            wait = next_scan - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                next_scan = time.time()
+
+    def latest(self, channel):
+        '''(value, timestamp) of the last published reading, or None'''
+        return self._latest.get(channel)
+
+
+if __name__ == "__main__":
+    adc = ADC({'channels': list(range(ADC.CHANNELS))})
+    adc.start()
+    while True:
+        print([adc.latest(c) for c in range(ADC.CHANNELS)])
+        time.sleep(0.5)
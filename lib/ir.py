@@ -1,25 +1,31 @@
 #!/usr/bin/env python3
 
 import time
-import Adafruit_GPIO.SPI as SPI
-import Adafruit_MCP3008
+from lib.adc import ADC
 
 
 class IR:
+    '''Sharp 10-80cm Infrared Distance Sensor on an MCP3008 channel'''
+
+    # https://www.upgradeindustries.com/product/58/Sharp-10-80cm-Infrared-Distance-Sensor-(GP2Y0A21YK0F)
+    # http://www.instructables.com/id/Get-started-with-distance-sensors-and-Arduino/
+    # cm for every raw ADC value, computed once:
+    _table = [0] + [12343.85 * (value**-1.15)
+                    for value in range(1, ADC.MAX_VALUE + 1)]
+
+    def __init__(self, channel=2, adc=None):
+        self.channel = channel
+        if adc is None:
+            adc = ADC({'channels': [channel]})
+        self._adc = adc
 
     def distance(self):
-        time.sleep(0.05)
-        # Hardware SPI configuration:
-        # https://www.upgradeindustries.com/product/58/Sharp-10-80cm-Infrared-Distance-Sensor-(GP2Y0A21YK0F)
-        # http://www.instructables.com/id/Get-started-with-distance-sensors-and-Arduino/
-        SPI_PORT = 0
-        SPI_DEVICE = 0
-        mcp = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE))
-        value = mcp.read_adc(2)
-        cm = 0
-        if value:
-            cm = 12343.85 * (value**-1.15)
-        return cm
+        '''cm. Served from the ADC's background loop when it is running.'''
+        if self._adc.running():
+            latest = self._adc.latest(self.channel)
+            if latest is not None:
+                return self._table[latest[0]]
+        return self._table[self._adc.read(self.channel)]
 
 if __name__ == "__main__":
     ir = IR()
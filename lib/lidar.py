@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 import Adafruit_GPIO.I2C as I2C
+import logging
+import threading
 import time
+from array import array
+
+from util.metrics import Histogram, registry
+
+logger = logging.getLogger(__name__)
 
 
 ##########################################################################
@@ -51,9 +58,31 @@ class Lidar:
     __ACQ_SETTINGS = 0x5D
     __POWER_CONTROL = 0x65
 
-    def __init__(self, address=0x62, rate=270):
+    # Setting the high bit of a register address makes the sensor
+    # auto-increment, so both distance bytes come back in one read.
+    __AUTO_INCREMENT = 0x80
+    # bytes on the bus besides the data: address + write, register,
+    # address + read:
+    __OVERHEAD = 3
+
+    def __init__(self, address=0x62, rate=270, buffer_size=1024,
+                 block_read=True, metrics=True):
+        '''metrics: publish the lidar.* stats; off for a second instance,
+        such as a benchmark's, so it does not replace the HAL's'''
         self.i2c = I2C.get_i2c_device(address)
         self.rate = rate
+        self.block_read = block_read
+        # for measuring bus usage:
+        self.transactions = 0
+        self.bus_bytes = 0
+        self.samples = 0
+        if metrics:
+            self._read_time = registry.histogram('lidar.read')
+            registry.gauge('lidar.transactions', lambda: self.transactions)
+            registry.gauge('lidar.bus_bytes', lambda: self.bus_bytes)
+            registry.gauge('lidar.samples', lambda: self.samples)
+        else:
+            self._read_time = Histogram()
         # continuously sample
         self.i2c.write8(self.__OUTER_LOOP_COUNT, 0xFF)
 
@@ -76,6 +105,16 @@ class Lidar:
         self._last_read = time.time()
         self.read()
 
+        # Ring buffer for continuous acquisition. Only the acquisition
+        # thread writes; readers never take a lock.
+        self._size = buffer_size
+        self._times = array('d', [0.0]) * buffer_size
+        self._distances = array('l', [0]) * buffer_size
+        self._velocities = array('l', [0]) * buffer_size
+        self._count = 0
+        self._thread = None
+        self._running = False
+
     def read(self):
         # Distance is in cm
         # Velocity is in cm between consecutive reads; sampling rate converts
@@ -84,19 +123,120 @@ class Lidar:
         if dur < self._read_delay:
             diff = self._read_delay - dur
             time.sleep(diff)
+        if self.block_read:
+            return self.__read_block()
+        start = time.perf_counter()
         dist1 = self.i2c.readU8(self.__FULL_DELAY_HIGH)
         dist2 = self.i2c.readU8(self.__FULL_DELAY_LOW)
         self._last_read = time.time()
         distance = ((dist1 << 8) + dist2)
         velocity = -self.i2c.readS8(self.__VELOCITY) * self.rate
+        self._read_time.record(time.perf_counter() - start)
+        self.__count(1, 1, 1)
+        self.samples += 1
         return distance, velocity
 
+    def __read_block(self):
+        '''Distance in one auto-increment read and velocity in another'''
+        start = time.perf_counter()
+        high, low = self.i2c.readList(
+            self.__AUTO_INCREMENT | self.__FULL_DELAY_HIGH, 2)
+        velocity = self.i2c.readS8(self.__VELOCITY)
+        self.__count(2, 1)
+        self._last_read = time.time()
+        self._read_time.record(time.perf_counter() - start)
+        self.samples += 1
+        return (high << 8) + low, -velocity * self.rate
+
+    def __count(self, *lengths):
+        '''Account for one transaction per data length'''
+        self.transactions += len(lengths)
+        self.bus_bytes += sum(lengths) + self.__OVERHEAD * len(lengths)
+
+    def transactions_per_sample(self):
+        if not self.samples:
+            return 0
+        return self.transactions / self.samples
+
+    def bytes_per_sample(self):
+        if not self.samples:
+            return 0
+        return self.bus_bytes / self.samples
+
     def distance(self):
         d, v = self.read()
         return d
 
+    def start(self):
+        '''Sample continuously on a background thread at the configured
+        rate. Use latest() and since() to get the samples.'''
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.__acquire, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._running
+
+    def __acquire(self):
+        while self._running:
+            # read() waits out the rest of the sample period:
+            try:
+                distance, velocity = self.read()
+            except OSError as e:
+                logger.warning('Lidar read failed: %s', e)
+                time.sleep(self._read_delay)
+                continue
+            i = self._count % self._size
+            self._times[i] = self._last_read
+            self._distances[i] = distance
+            self._velocities[i] = velocity
+            # publish only after the slot is complete:
+            self._count += 1
+
+    def latest(self):
+        '''Most recent (timestamp, distance, velocity), or None if nothing
+        has been sampled yet.'''
+        while True:
+            count = self._count
+            if count == 0:
+                return None
+            i = (count - 1) % self._size
+            sample = (self._times[i], self._distances[i],
+                      self._velocities[i])
+            # the slot is only rewritten once the writer has lapped us:
+            if self._count - count < self._size - 1:
+                return sample
+
+    def since(self, t):
+        '''All buffered samples taken after time t, oldest first.'''
+        count = self._count
+        samples = []
+        # walk back from the newest until we reach t:
+        for n in range(count - 1, max(0, count - self._size) - 1, -1):
+            i = n % self._size
+            sample = (self._times[i], self._distances[i],
+                      self._velocities[i])
+            if sample[0] <= t:
+                break
+            samples.append((n, sample))
+        # drop anything the writer overwrote while we were copying:
+        oldest = self._count - self._size + 1
+        samples.reverse()
+        return [sample for n, sample in samples if n >= oldest]
+
+
 if __name__ == "__main__":
     lidar = Lidar()
     while True:
-        print(lidar.read())
+        print(lidar.read(), 'transactions/sample:',
+              lidar.transactions_per_sample(), 'bytes/sample:',
+              lidar.bytes_per_sample())
         time.sleep(0.5)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
+import logging
+import threading
 import time
 import pigpio
 
+from lib import pi
+
+logger = logging.getLogger(__name__)
+
 default_config = {
     'board': {
         'pwm': {
@@ -32,66 +38,128 @@ default_config = {
 
 
 class Move:
+    '''Motions run in the background: each call starts (or takes over)
+    a motion and returns at once, and a timer stops the motors when its
+    time is up.'''
 
     def __init__(self, config=default_config):
         self.config = config
-        print("H-bridge config:", config)
+        logger.info('H-bridge config: %s', config)
 
-        self.__pi = pigpio.pi()
-        if not self.__pi.connected:
-            print("Could not connect to pigpiod.")
-            os.exit(1)
+        self.__pi = pi.shared()
 
         for pin in self.config['bcn']['pwm'].values():
             self.__pi.set_mode(pin, pigpio.OUTPUT)
+            # only the duty cycle changes from one motion to the next:
+            self.__pi.set_PWM_frequency(pin, 100)
         for pin in self.config['bcn']['driver'].values():
             self.__pi.set_mode(pin, pigpio.OUTPUT)
 
-    def __run_at_power(self, t, power=50):
-        self.__pi.set_PWM_frequency(self.config['bcn']['pwm']['left'], 100)
-        self.__pi.set_PWM_frequency(self.config['bcn']['pwm']['right'], 100)
+        self.__lock = threading.Lock()
+        self.__timer = None
+        self.__motion = None
+
+    def __del__(self):
+        pi.release(self.__pi)
+
+    def __set_power(self, power):
         self.__pi.set_PWM_dutycycle(self.config['bcn']['pwm'][
                                     'left'], (power / 100) * 255)  # 255 is on
         self.__pi.set_PWM_dutycycle(self.config['bcn']['pwm'][
                                     'right'], (power / 100) * 255)  # 255 is on
-        time.sleep(t)
+
+    def __run_at_power(self, name, pins, t, power=50):
+        '''Start a motion, replacing any running one without stopping the
+        motors in between. The same motion again just moves the deadline.'''
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+            motion = self.__motion
+            if motion is None or motion['pins'] != pins:
+                driver = self.config['bcn']['driver']
+                self.__pi.write_bank(dict(zip(
+                    (driver['in4'], driver['in3'],
+                     driver['in2'], driver['in1']), pins)))
+            if motion is None or motion['power'] != power \
+                    or motion['pins'] != pins:
+                self.__set_power(power)
+            now = time.time()
+            self.__motion = {
+                'direction': name,
+                'pins': pins,
+                'power': power,
+                'started': now if motion is None or
+                motion['direction'] != name else motion['started'],
+                'deadline': now + t,
+            }
+            self.__timer = threading.Timer(t, self.__expire, (self.__motion,))
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def __expire(self, motion):
+        with self.__lock:
+            # a newer motion may have taken over while we waited:
+            if self.__motion is motion:
+                self.__halt()
+                logger.debug('movement done')
+
+    def __halt(self):
         self.__pi.set_PWM_dutycycle(self.config['bcn']['pwm'][
                                     'left'], 0)
         self.__pi.set_PWM_dutycycle(self.config['bcn']['pwm'][
                                     'right'], 0)
+        self.__motion = None
+
+    def stop(self):
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+            self.__halt()
+
+    def status(self):
+        '''Current motion and seconds remaining, or None if stopped'''
+        motion = self.__motion
+        if motion is None:
+            return None
+        return {
+            'direction': motion['direction'],
+            'power': motion['power'],
+            'elapsed': time.time() - motion['started'],
+            'remaining': max(0.0, motion['deadline'] - time.time()),
+        }
 
-    def __toggle(self, a, b, c, d, t, power=50):
-        self.__pi.write(self.config['bcn']['driver']['in4'], a)
-        self.__pi.write(self.config['bcn']['driver']['in3'], b)
-        self.__pi.write(self.config['bcn']['driver']['in2'], c)
-        self.__pi.write(self.config['bcn']['driver']['in1'], d)
-        self.__run_at_power(t, power)
+    def wait(self):
+        '''Block until the current motion is done'''
+        timer = self.__timer
+        if timer is not None:
+            timer.join()
 
     def forward(self, t, power=50):
-        print("forward @ " + str(power) + " for t=" + str(t))
-        self.__toggle(False, True, True, False, t, power)
-        print("movement done")
+        logger.debug('forward @ %s for t=%s', power, t)
+        self.__run_at_power('forward', (False, True, True, False), t, power)
 
     def backward(self, t, power=50):
-        print("backward @ " + str(power) + " for t=" + str(t))
-        self.__toggle(True, False, False, True, t, power)
-        print("movement done")
+        logger.debug('backward @ %s for t=%s', power, t)
+        self.__run_at_power('backward', (True, False, False, True), t, power)
 
     def turn_left(self, t, power=50):
-        self.__toggle(False, True, False, False, t, power)
+        self.__run_at_power('turn_left', (False, True, False, False),
+                            t, power)
 
     def turn_right(self, t, power=50):
-        self.__toggle(True, True, True, False, t, power)
+        self.__run_at_power('turn_right', (True, True, True, False),
+                            t, power)
 
     def counter_clockwise(self, t, power=50):
-        print("counter_clockwise @ " + str(power) + " for t=" + str(t))
-        self.__toggle(False, True, False, True, t, power)
-        print("movement done")
+        logger.debug('counter_clockwise @ %s for t=%s', power, t)
+        self.__run_at_power('counter_clockwise', (False, True, False, True),
+                            t, power)
 
     def clockwise(self, t, power=50):
-        print("clockwise @ " + str(power) + " for t=" + str(t))
-        self.__toggle(True, False, True, False, t, power)
-        print("movement done")
+        logger.debug('clockwise @ %s for t=%s', power, t)
+        self.__run_at_power('clockwise', (True, False, True, False),
+                            t, power)
 
 
 if __name__ == "__main__":
@@ -99,3 +167,4 @@ if __name__ == "__main__":
     # move.counter_clockwise(0.1)
     # move.clockwise(0.1)
     move.forward(1, 20)
+    move.wait()
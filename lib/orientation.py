@@ -1,48 +1,131 @@
 #!/usr/bin/env python3
 
 from Adafruit_BNO055 import BNO055
+import logging
+import threading
 import time
 
+from util.metrics import registry
+
+logger = logging.getLogger(__name__)
+
 
 class Orientation:
+    _config = {
+        # poll on a background thread and serve reads from the cache:
+        'background': False,
+        'pollRatePerSecond': 100,
+        # calibration changes slowly, so it is read less often:
+        'calibrationRatePerSecond': 1,
+    }
 
-    def __init__(self):
+    def __init__(self, config=None):
+        if config:
+            self._config.update(config)
         # use i2c by not passing arg in constructor
         self.bno055 = BNO055.BNO055()
         if not self.bno055.begin():
             raise RuntimeError(
                 'Failed to initialize BNO055! Is the sensor connected?')
         self.__self_test()
+        # latest value and timestamp of each output:
+        self._cache = {}
+        self._read_time = registry.histogram('bno055.read')
+        self._transactions = registry.counter('bno055.transactions')
+        self._thread = None
+        self._running = False
+        if self._config['background']:
+            self.start()
 
     def __self_test(self):
-        print('Running BNO055 self test')
-        # Print system status and self test result.
+        logger.info('Running BNO055 self test')
+        # Log system status and self test result.
         status, self_test, error = self.bno055.get_system_status()
-        print('System status: {0}'.format(status))
-        print('Self test result (0x0F is normal): 0x{0:02X}'.format(self_test))
-        # Print out an error if system status is in error mode.
+        logger.info('System status: %s', status)
+        logger.info('Self test result (0x0F is normal): 0x%02X', self_test)
+        # Log an error if system status is in error mode.
         if status == 0x01:
-            print('System error: {0}'.format(error))
-            print('See datasheet section 4.3.59 for the meaning.')
+            logger.error('System error: %s. See datasheet section 4.3.59 '
+                         'for the meaning.', error)
         sw, bl, accel, mag, gyro = self.bno055.get_revision()
-        print('Software version:   {0}'.format(sw))
-        print('Bootloader version: {0}'.format(bl))
-        print('Accelerometer ID:   0x{0:02X}'.format(accel))
-        print('Magnetometer ID:    0x{0:02X}'.format(mag))
-        print('Gyroscope ID:       0x{0:02X}\n'.format(gyro))
+        logger.info('Software version: %s, bootloader version: %s, '
+                    'accelerometer ID: 0x%02X, magnetometer ID: 0x%02X, '
+                    'gyroscope ID: 0x%02X', sw, bl, accel, mag, gyro)
 
     def read(self):
         time.sleep(0.01)
         # heading, roll, pitch = self.bno055.read_euler()
         # sys, gyro, accel, mag = self.bno055.get_calibration_status()
-        return self.bno055.read_euler(), self.bno055.get_calibration_status()
+        with self._read_time.time():
+            result = (self.bno055.read_euler(),
+                      self.bno055.get_calibration_status())
+        self._transactions.add(2)
+        return result
 
     def euler(self):
+        if self._running and 'euler' in self._cache:
+            return self._cache['euler'][0]
         time.sleep(0.01)
         euler, cal = self.read()
         # heading, roll, pitch = euler
         return euler
 
+    def start(self):
+        '''Poll the sensor on a background thread. latest() and euler()
+        then return cached values without touching the bus.'''
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.__poll, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._running
+
+    def __poll(self):
+        period = 1.0 / self._config['pollRatePerSecond']
+        calibration_period = 1.0 / self._config['calibrationRatePerSecond']
+        next_poll = time.time()
+        next_calibration = next_poll
+        while self._running:
+            start = time.perf_counter()
+            try:
+                # each entry is replaced whole, so readers never see a
+                # value paired with the wrong timestamp:
+                self._cache['euler'] = (self.bno055.read_euler(), time.time())
+                self._cache['quaternion'] = (self.bno055.read_quaternion(),
+                                             time.time())
+                self._cache['gyro'] = (self.bno055.read_gyroscope(),
+                                       time.time())
+                self._transactions.add(3)
+                if time.time() >= next_calibration:
+                    self._cache['calibration'] = (
+                        self.bno055.get_calibration_status(), time.time())
+                    self._transactions.add(1)
+                    next_calibration += calibration_period
+            except (OSError, RuntimeError) as e:
+                logger.warning('BNO055 read failed: %s', e)
+            self._read_time.record(time.perf_counter() - start)
+            next_poll += period
+            wait = next_poll - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                # fell behind; do not try to catch up:
+                next_poll = time.time()
+
+    def latest(self):
+        '''Cached outputs as {name: (value, timestamp)}: euler (heading,
+        roll, pitch), quaternion (x, y, z, w), gyro (x, y, z deg/s) and
+        calibration (sys, gyro, accel, mag).'''
+        return dict(self._cache)
+
 
 if __name__ == "__main__":
     orientation = Orientation()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import time
+import pigpio
+
+from util.metrics import registry
+
+
+##########################################################################
+#  Shared pigpiod connection
+##########################################################################
+#  Every pigpio call is a round trip over a socket to pigpiod, so drivers
+#  share one connection and the round trips are counted. Pins use pigpio
+#  (BCM) numbering.
+#
+class Pi:
+
+    def __init__(self):
+        self._pi = pigpio.pi()
+        if not self._pi.connected:
+            raise RuntimeError('Could not connect to pigpiod.')
+        self.round_trips = 0
+        self.users = 0
+        self._call_time = registry.histogram('pigpio.call')
+        registry.gauge('pigpio.round_trips', lambda: self.round_trips)
+
+    def __getattr__(self, name):
+        attr = getattr(self._pi, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.round_trips += 1
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            self._call_time.record(time.perf_counter() - start)
+            return result
+        # only look it up once:
+        setattr(self, name, counted)
+        return counted
+
+    @staticmethod
+    def mask(pins):
+        bits = 0
+        for pin in pins:
+            bits |= 1 << pin
+        return bits
+
+    def write_bank(self, levels):
+        '''Set several pins (all below 32) in at most two round trips.
+        levels maps pin to level.'''
+        high = self.mask(p for p, level in levels.items() if level)
+        low = self.mask(p for p, level in levels.items() if not level)
+        if high:
+            self.set_bank_1(high)
+        if low:
+            self.clear_bank_1(low)
+
+
+_shared = None
+_lock = threading.Lock()
+
+
+def shared():
+    '''The process wide connection. Call release() when done with it.'''
+    global _shared
+    with _lock:
+        if _shared is None:
+            _shared = Pi()
+        _shared.users += 1
+        return _shared
+
+
+def _after_fork():
+    # a forked child must not talk over its parent's pigpiod socket:
+    global _shared, _lock
+    _shared = None
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def release(pi):
+    global _shared
+    with _lock:
+        pi.users -= 1
+        if pi.users == 0 and pi is _shared:
+            pi.stop()
+            _shared = None
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import numpy
+
+from util.scanframe import POINT_DTYPE
+
+##########################################################################
+#  Scan readings to Cartesian points
+##########################################################################
+#  Robot frame, in cm: x forward, y left, z up, origin at the robot's
+#  reference point. The roof mount pivot sits at `offset` in that frame.
+#  Horizontal position is clockwise from home seen from above, vertical
+#  position is degrees above the horizon.
+#
+class PointCloud:
+    '''Converts batches of scan readings to points in one vectorized pass,
+    using sin/cos tables for every stepper step and for servo angles in
+    tenths of a degree.'''
+
+    # tenths of a degree
+    _vertical_resolution = 10
+
+    def __init__(self, steps_per_revolution, offset=(0.0, 0.0, 0.0)):
+        self._steps = steps_per_revolution
+        self._offset = numpy.asarray(offset, dtype=numpy.float32)
+        azimuth = -numpy.arange(steps_per_revolution) * \
+            (2 * numpy.pi / steps_per_revolution)
+        self._cos_h = numpy.cos(azimuth).astype(numpy.float32)
+        self._sin_h = numpy.sin(azimuth).astype(numpy.float32)
+        elevation = numpy.radians(
+            numpy.arange(-90 * self._vertical_resolution,
+                         90 * self._vertical_resolution + 1) /
+            self._vertical_resolution)
+        self._cos_v = numpy.cos(elevation).astype(numpy.float32)
+        self._sin_v = numpy.sin(elevation).astype(numpy.float32)
+        self.dtype = numpy.dtype(POINT_DTYPE)
+
+    def points(self, readings):
+        '''readings is a list of reading dicts, or a structured array with
+        step, lidar, timestamp and optionally vertical_position fields.'''
+        if isinstance(readings, numpy.ndarray):
+            step = readings['step']
+            distance = readings['lidar']
+            timestamp = readings['timestamp']
+            if 'vertical_position' in readings.dtype.names:
+                vertical = readings['vertical_position']
+            else:
+                vertical = numpy.zeros(len(readings))
+        else:
+            n = len(readings)
+            step = numpy.fromiter((r['step'] for r in readings),
+                                  numpy.int64, n)
+            distance = numpy.fromiter((r['lidar'] for r in readings),
+                                      numpy.float32, n)
+            vertical = numpy.fromiter(
+                (r['vertical_position'] for r in readings), numpy.float32, n)
+            timestamp = numpy.fromiter((r['timestamp'] for r in readings),
+                                       numpy.float64, n)
+        h = numpy.asarray(step, dtype=numpy.int64) % self._steps
+        v = numpy.clip(numpy.rint(
+            (numpy.asarray(vertical) + 90) * self._vertical_resolution)
+            .astype(numpy.int64), 0, len(self._cos_v) - 1)
+        r = numpy.asarray(distance, dtype=numpy.float32)
+        flat = r * self._cos_v[v]
+        out = numpy.empty(len(r), dtype=self.dtype)
+        out['x'] = flat * self._cos_h[h] + self._offset[0]
+        out['y'] = flat * self._sin_h[h] + self._offset[1]
+        out['z'] = r * self._sin_v[v] + self._offset[2]
+        out['lidar'] = numpy.clip(r, 0, 0xFFFF)
+        out['timestamp'] = timestamp
+        return out
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import logging
 import time
 
 from lib.stepper import Stepper
@@ -7,6 +8,8 @@ from lib.servo import Servo
 
 from lib.lidar import Lidar
 
+logger = logging.getLogger(__name__)
+
 
 class RoofMount:
 
@@ -20,29 +23,48 @@ class RoofMount:
         },
         'lidar': {
             'enabled': True,
-            'updateRatePerSecond': 270
+            'updateRatePerSecond': 270,
+            # sample on a background thread into a ring buffer:
+            'continuous': False,
+            'bufferSize': 1024,
+            # two reads per sample instead of three:
+            'blockRead': True,
+            # position of the mount pivot on the robot (x, y, z) in cm:
+            'offset': [0.0, 0.0, 0.0]
         }
     }
 
-    def __init__(self, config={}):
+    def __init__(self, config={}, lidar=None):
+        '''lidar: something with the Lidar interface to use instead of
+        opening the sensor here, such as a worker process proxy'''
         self._config.update(config)
         self._stepper = Stepper()
         self._stepper.disable()
         self._servo = Servo()
-        self.set_vertical_position(0)
-        self._lidar = Lidar()
+        # the first scan or move waits for (or takes over from) this:
+        self.set_vertical_position(0, wait=False)
+        if lidar is not None:
+            self._lidar = lidar
+        else:
+            lidar = self._config['lidar']
+            self._lidar = Lidar(rate=lidar['updateRatePerSecond'],
+                                buffer_size=lidar.get('bufferSize', 1024),
+                                block_read=lidar.get('blockRead', True))
+            if lidar.get('continuous', False):
+                self._lidar.start()
+        self._point_cloud = None
 
     def up(self, degrees=10):
         '''Move up relative to current position'''
         try:
-            self._servo.set_position(self._servo.position - degrees)
+            self._servo.set_position(self._servo.position() - degrees)
         except:
             pass
 
     def down(self, degrees=10):
         '''Move down relative to current position'''
         try:
-            self._servo.set_position(self._servo.position + degrees)
+            self._servo.set_position(self._servo.position() + degrees)
         except:
             pass
 
@@ -68,8 +90,9 @@ class RoofMount:
 
     def home(self):
         '''Move stepper and servo to home positions'''
+        tilt = self._servo.move(self._config['servo']['level_degrees'])
         self._stepper.home()
-        self.level()
+        tilt.result()
 
     def horizontal_position(self):
         return self._stepper.position()
@@ -87,42 +110,248 @@ class RoofMount:
         else:
             self.__rotate(Stepper.COUNTER_CLOCKWISE, degrees)
 
-    def set_vertical_position(self, degrees):
-        '''Position relative to the horizon'''
-        min = -(self._config['servo']['max_degrees'] -
-                self._config['servo']['level_degrees'])
-        max = -(self._config['servo']['min_degrees'] -
-                self._config['servo']['level_degrees'])
+    def set_vertical_position(self, degrees, wait=True):
+        '''Position relative to the horizon. Without wait, returns the
+        servo move's Future (None when out of range) straight away.'''
+        min, max = self.__vertical_limits()
         if degrees < min or degrees > max:
-            print('Position ', degrees,
-                  'out of range (', min, ',', max, ')')
-            return
-        pos = -degrees + self._config['servo']['level_degrees']
-        self._servo.set_position(pos)
+            logger.warning('Position %s out of range (%s, %s)',
+                           degrees, min, max)
+            return None
+        move = self._servo.move(self.__servo_degrees(degrees))
+        if wait:
+            move.result()
+        return move
+
+    def vertical_trajectory(self, waypoints, wait=True):
+        '''Tilt through each position relative to the horizon in turn'''
+        min, max = self.__vertical_limits()
+        for degrees in waypoints:
+            if degrees < min or degrees > max:
+                raise ValueError('Position %s out of range (%s, %s)'
+                                 % (degrees, min, max))
+        move = self._servo.trajectory(
+            [self.__servo_degrees(d) for d in waypoints])
+        if wait:
+            move.result()
+        return move
+
+    def point(self, horizontal, vertical):
+        '''Pan and tilt at the same time; takes as long as the slower of
+        the two rather than both one after the other.'''
+        tilt = self.set_vertical_position(vertical, wait=False)
+        self.set_horizontal_position(horizontal)
+        if tilt is not None:
+            tilt.result()
+
+    def __servo_degrees(self, degrees):
+        return -degrees + self._config['servo']['level_degrees']
+
+    def __lidar_sample(self):
+        '''(distance, velocity, timestamp) without waiting on the lidar
+        when it is sampling in the background.'''
+        if self._lidar.running():
+            sample = self._lidar.latest()
+            if sample is not None:
+                t, distance, velocity = sample
+                return distance, velocity, t
+        distance, velocity = self._lidar.read()
+        return distance, velocity, time.time()
+
+    def lidar_reading(self):
+        distance, velocity, t = self.__lidar_sample()
+        return {'lidar': distance, 'velocity': velocity, 'timestamp': t}
+
+    def lidar_since(self, t):
+        '''Lidar (timestamp, distance, velocity) samples taken after t, when
+        the lidar is sampling in the background; otherwise none.'''
+        if not self._lidar.running():
+            return []
+        return self._lidar.since(t)
+
+    def position(self):
+        return {
+            'vertical_position': self.vertical_position(),
+            'horizontal_position': self.horizontal_position(),
+        }
 
     def get_readings(self):
+        distance, velocity, t = self.__lidar_sample()
         return {
             'vertical_position': self.vertical_position(),
             'horizontal_position': self.horizontal_position(),
-            'lidar': self._lidar.distance(),
+            'lidar': distance,
         }
 
     def horizontal_scan(self, vertical_degrees, resolution=1.0, callback=None):
         '''Performs a 360 scan at a specified angle. Resolution is a
         percentage and dictates how often a readings is performed during
         the scan.'''
-        print("Performing scan.")
+        logger.info('Performing scan.')
         readings = []
         self.set_vertical_position(vertical_degrees)
+        vertical = self.vertical_position()
         self._stepper.enable()
-        for step in range(self._stepper._stepsPerRevolution):
-            self._stepper.step()
-            if step % (1 / resolution) == 0:
-                reading = self.get_readings()
-                readings.append(reading)
-                if callback is not None:
-                    callback(reading)
-        self._stepper.disable()
+        try:
+            for step in range(self._stepper._stepsPerRevolution):
+                self._stepper.step()
+                if step % (1 / resolution) == 0:
+                    reading = self.__scan_reading(vertical)
+                    readings.append(reading)
+                    if callback is not None:
+                        callback(reading)
+        finally:
+            self._stepper.disable()
+        return readings
+
+    def __scan_reading(self, vertical):
+        distance, velocity, t = self.__lidar_sample()
+        return {
+            'vertical_position': vertical,
+            'horizontal_position': self.horizontal_position(),
+            'lidar': distance,
+            'velocity': velocity,
+            'step': self._stepper._steps,
+            'timestamp': t,
+        }
+
+    def __vertical_limits(self):
+        low = -(self._config['servo']['max_degrees'] -
+                self._config['servo']['level_degrees'])
+        high = -(self._config['servo']['min_degrees'] -
+                 self._config['servo']['level_degrees'])
+        return low, high
+
+    def volume_scan(self, low, high, increment, resolution=1.0,
+                    callback=None):
+        '''Performs 360 scans at every elevation from low to high (degrees
+        relative to the horizon) in increments. Rings alternate direction
+        so the head never winds back, and the servo starts moving to the
+        next elevation during the last steps of each ring. No readings are
+        taken while the servo is moving.'''
+        logger.info('Performing volume scan.')
+        lowest, highest = self.__vertical_limits()
+        low, high = sorted((low, high))
+        increment = abs(increment)
+        if increment == 0:
+            raise ValueError('increment must not be 0')
+        elevations = []
+        e = low
+        while e <= high:
+            if lowest <= e <= highest:
+                elevations.append(e)
+            e += increment
+        readings = []
+        if not elevations:
+            return readings
+        stepper = self._stepper
+        steps = stepper._stepsPerRevolution
+        step_time = 2 * stepper._stepDelay
+        self.set_vertical_position(elevations[0])
+        direction = stepper.direction()
+        tilt = None
+        stepper.enable()
+        try:
+            for ring, elevation in enumerate(elevations):
+                vertical = self.vertical_position()
+                if ring + 1 < len(elevations):
+                    target = self.__servo_degrees(elevations[ring + 1])
+                    overlap = min(steps, int(
+                        self._servo.move_time(target) / step_time) + 1)
+                else:
+                    overlap = 0
+                stepper.set_direction(direction)
+                tilt = None
+                for step in range(steps):
+                    if overlap and step == steps - overlap:
+                        tilt = self.set_vertical_position(
+                            elevations[ring + 1], wait=False)
+                    stepper.step()
+                    if tilt is None and step % (1 / resolution) == 0:
+                        reading = self.__scan_reading(vertical)
+                        readings.append(reading)
+                        if callback is not None:
+                            callback(reading)
+                if tilt is not None:
+                    tilt.result()
+                # serpentine:
+                if direction == Stepper.CLOCKWISE:
+                    direction = Stepper.COUNTER_CLOCKWISE
+                else:
+                    direction = Stepper.CLOCKWISE
+        finally:
+            stepper.disable()
+            # let a move started for the next ring finish:
+            if tilt is not None:
+                tilt.result()
+        return readings
+
+    def point_cloud(self, readings):
+        '''Scan readings as a structured NumPy array of x, y, z points in
+        the robot frame. Needs NumPy.'''
+        if self._point_cloud is None:
+            # NumPy is only needed by clients that ask for points:
+            from lib.pointcloud import PointCloud
+            self._point_cloud = PointCloud(
+                self._stepper._stepsPerRevolution,
+                self._config['lidar'].get('offset', (0.0, 0.0, 0.0)))
+        return self._point_cloud.points(readings)
+
+    def continuous_scan(self, vertical_degrees, rate=None, callback=None):
+        '''Performs a 360 scan at a specified angle without stopping. The
+        stepper turns at a constant rate (steps per second) while the lidar
+        samples in the background, and each sample's horizontal position
+        is interpolated from its timestamp.'''
+        logger.info('Performing continuous scan.')
+        readings = []
+        self.set_vertical_position(vertical_degrees)
+        vertical = self.vertical_position()
+        started_lidar = not self._lidar.running()
+        if started_lidar:
+            self._lidar.start()
+        stepper = self._stepper
+        first = stepper._steps
+        if stepper.direction() == Stepper.CLOCKWISE:
+            sign = 1
+        else:
+            sign = -1
+        poll = 1.0 / self._lidar.rate
+        train = None
+        stepper.enable()
+        try:
+            train = stepper.run(stepper._stepsPerRevolution, rate)
+            last = train.started
+            while True:
+                finished = train.done()
+                end = train.started + train.duration
+                for t, distance, velocity in self._lidar.since(last):
+                    if t > end:
+                        break
+                    last = t
+                    steps = first + sign * train.position_at(t)
+                    reading = {
+                        'vertical_position': vertical,
+                        'horizontal_position':
+                            (steps * stepper._degrees_per_step) % 360,
+                        'lidar': distance,
+                        'velocity': velocity,
+                        'step':
+                            int(round(steps)) % stepper._stepsPerRevolution,
+                        'timestamp': t,
+                    }
+                    readings.append(reading)
+                    if callback is not None:
+                        callback(reading)
+                if finished:
+                    break
+                time.sleep(poll)
+        finally:
+            if train is not None and not train.done():
+                train.stop()
+                train.result()
+            stepper.disable()
+            if started_lidar:
+                self._lidar.stop()
         return readings
 
 
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
+import logging
+import threading
 import time
-import os
 import pigpio
 import RPi.GPIO as GPIO
+from concurrent.futures import Future
+
+from lib import pi
+
+logger = logging.getLogger(__name__)
 
 SG5010 = {
     'secondsPer60deg': 0.19,
@@ -24,6 +30,11 @@ HD1160A = {
 
 
 class Servo:
+    '''Moves return straight away with a Future that resolves to the
+    position reached once the servo has had time to get there, when its
+    pulse is switched off again. A new move takes over from one still in
+    progress, resolving that one's future with where it got to.'''
+
     _config = {
         'gpio': 37,
         'gpioBCN': 26,
@@ -42,42 +53,117 @@ class Servo:
     def __init__(self, config=None):
         if config:
             self._config.update(config)
-        print("Servo config: ", config)
-
-        self.__pi = pigpio.pi()
-        if not self.__pi.connected:
-            print("Could not connect to pigpiod.")
-            os.exit(1)
+        logger.info('Servo config: %s', config)
+
+        self.__lock = threading.Lock()
+        # the move in progress: (future, start, target, started, spin),
+        # and the timer that ends it:
+        self.__motion = None
+        self.__timer = None
+        self.__pi = pi.shared()
         self.__pi.set_mode(self._config['gpioBCN'], pigpio.OUTPUT)
-        self.set_position(0)  # move to center position
+        self.move(0)  # move to center position
 
     def __del__(self):
-        self.__pi.stop()
+        pi.release(self.__pi)
 
     def __calc_pulse_width(self, deg):
         pos = (self._config['calibration']['left'] -
                self._config['calibration']['right']) / 180
         return pos * (deg + 90) + self._config['calibration']['right']
 
-    def __spin_time(self, deg):
-        if deg > self.__pos:
-            diff = deg - self.__pos
-        else:
-            diff = self.__pos - deg
+    def __spin_time(self, deg, start=None):
+        if start is None:
+            start = self.position()
         return ((self._config['secondsPer60deg'] *
-                 self._config['loadCoefficient']) * (diff / 60))
+                 self._config['loadCoefficient']) * (abs(deg - start) / 60))
+
+    def move_time(self, deg):
+        '''Seconds set_position(deg) takes from the current position'''
+        return 0.1 + self.__spin_time(deg)
 
     def set_position(self, deg):
-        if deg > 75 or deg < -75:
-            raise ValueError("Must be between -75 and 75")
+        '''Move and wait until the servo is there'''
+        self.move(deg).result()
+
+    def move(self, deg):
+        '''Start moving to deg; returns a Future'''
+        return self.trajectory([deg])
+
+    def trajectory(self, waypoints):
+        '''Move through each position in turn without switching the pulse
+        off in between. Returns a Future for the whole trajectory.'''
+        for deg in waypoints:
+            if deg > 75 or deg < -75:
+                raise ValueError("Must be between -75 and 75")
+        future = Future()
+        with self.__lock:
+            self.__preempt()
+            self.__next(future, list(waypoints))
+        return future
+
+    def __next(self, future, waypoints):
+        # with the lock held
+        deg = waypoints.pop(0)
+        start = self.__position()
+        spin = self.__spin_time(deg, start)
         self.__pi.set_servo_pulsewidth(
             self._config['gpioBCN'], self.__calc_pulse_width(deg))
-        time.sleep(0.1 + self.__spin_time(deg))
-        self.__pi.set_servo_pulsewidth(self._config['gpioBCN'], 0)
-        self.__pos = deg
+        self.__motion = (future, start, deg, time.time(), spin)
+        # the last waypoint gets time to settle before the pulse stops:
+        settle = 0.1 if not waypoints else 0
+        self.__timer = threading.Timer(
+            spin + settle, self.__arrive, (self.__motion, waypoints))
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def __arrive(self, motion, waypoints):
+        with self.__lock:
+            # a newer move may have taken over while we waited:
+            if self.__motion is not motion:
+                return
+            future, start, deg, started, spin = motion
+            self.__pos = deg
+            if waypoints:
+                self.__next(future, waypoints)
+                return
+            self.__pi.set_servo_pulsewidth(self._config['gpioBCN'], 0)
+            self.__motion = None
+            self.__timer = None
+        future.set_result(deg)
+
+    def __preempt(self):
+        # with the lock held
+        if self.__motion is None:
+            return
+        self.__timer.cancel()
+        future = self.__motion[0]
+        self.__pos = self.__position()
+        self.__motion = None
+        self.__timer = None
+        future.set_result(self.__pos)
+
+    def __position(self):
+        '''Estimated position, interpolated during a move'''
+        if self.__motion is None:
+            return self.__pos
+        future, start, deg, started, spin = self.__motion
+        if spin <= 0:
+            return deg
+        done = min(1.0, (time.time() - started) / spin)
+        return start + (deg - start) * done
+
+    def stop(self):
+        '''Switch the pulse off where the servo is now'''
+        with self.__lock:
+            self.__preempt()
+            self.__pi.set_servo_pulsewidth(self._config['gpioBCN'], 0)
+
+    def moving(self):
+        return self.__motion is not None
 
     def position(self):
-        return self.__pos
+        return self.__position()
 
 
 def self_test():
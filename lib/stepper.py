@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
+import logging
 import time
 import sys
+import threading
+import pigpio
 import RPi.GPIO as gpio
+from array import array
+from bisect import bisect_right
+from concurrent.futures import Future
+
+from lib import pi
+
+logger = logging.getLogger(__name__)
 
 #
 # Nema 17
@@ -13,6 +23,155 @@ import RPi.GPIO as gpio
 #
 
 
+class StepTrain:
+    '''A run of step pulses played out by pigpio's DMA waveform engine, so
+    pulse timing does not depend on the Python interpreter. The rate ramps
+    linearly from start_rate up to rate over the first `ramp` steps and back
+    down over the last `ramp` steps.
+
+    `future` resolves to the number of steps taken once the train is done.'''
+
+    # steps per repeated cruise wave; the chain loops it:
+    _cruise_block = 100
+    _max_loops = 0xFFFF
+
+    def __init__(self, pi, gpio, steps, rate, ramp=0, start_rate=None,
+                 on_done=None):
+        self._pi = pi
+        self._on_done = on_done
+        self._mask = 1 << gpio
+        self.steps = steps
+        ramp = min(ramp, steps // 2)
+        if start_rate is None or start_rate > rate:
+            start_rate = rate
+        # period of each step in microseconds:
+        periods = []
+        for n in range(steps):
+            edge = min(n, steps - 1 - n)
+            if edge < ramp:
+                r = start_rate + (rate - start_rate) * edge / ramp
+            else:
+                r = rate
+            periods.append(max(2, int(round(1000000 / r))))
+        self._periods = periods
+        self._ramp = ramp
+        # start time of each step, in seconds from the start of the train:
+        self.schedule = array('d', [0.0]) * steps
+        t = 0
+        for n in range(steps):
+            self.schedule[n] = t / 1000000
+            t += periods[n]
+        self.duration = t / 1000000
+        self.started = None
+        self.future = Future()
+        self._waves = []
+        self._stopped = False
+        self._stopped_at = None
+        self._stop = threading.Event()
+
+    def __wave(self, periods):
+        pulses = []
+        for period in periods:
+            high = period // 2
+            pulses.append(pigpio.pulse(self._mask, 0, high))
+            pulses.append(pigpio.pulse(0, self._mask, period - high))
+        self._pi.wave_add_generic(pulses)
+        wid = self._pi.wave_create()
+        self._waves.append(wid)
+        return wid
+
+    def __chain(self):
+        '''Ramp up, looped cruise blocks, remainder, ramp down.'''
+        chain = []
+        ramp, steps = self._ramp, self.steps
+        if ramp:
+            chain.append(self.__wave(self._periods[:ramp]))
+        cruise = steps - 2 * ramp
+        blocks, remainder = divmod(cruise, self._cruise_block)
+        if blocks:
+            wid = self.__wave(
+                self._periods[ramp:ramp + self._cruise_block])
+            while blocks:
+                loops = min(blocks, self._max_loops)
+                chain += [255, 0, wid, 255, 1, loops & 0xFF, loops >> 8]
+                blocks -= loops
+        if remainder:
+            chain.append(self.__wave(
+                self._periods[steps - ramp - remainder:steps - ramp]))
+        if ramp:
+            chain.append(self.__wave(self._periods[steps - ramp:]))
+        return chain
+
+    def start(self):
+        self._pi.wave_clear()
+        chain = self.__chain()
+        self.started = time.time()
+        if chain:
+            self._pi.wave_chain(chain)
+        threading.Thread(target=self.__watch, daemon=True).start()
+        return self
+
+    def __watch(self):
+        try:
+            # sleep through most of the train, then poll for the end:
+            self._stop.wait(max(0, self.duration - 0.005))
+            while not self._stopped and self._pi.wave_tx_busy():
+                time.sleep(0.001)
+            done = self.steps_done()
+            for wid in self._waves:
+                self._pi.wave_delete(wid)
+            # bookkeeping first, so waiters see it:
+            if self._on_done is not None:
+                self._on_done(done)
+        except Exception as e:
+            # never leave waiters hanging:
+            self.future.set_exception(e)
+            raise
+        self.future.set_result(done)
+
+    def stop(self):
+        '''Cut the train short. The future still reports the steps taken.'''
+        self._pi.wave_tx_stop()
+        # the watcher may be polling; it reads _stopped_at once it sees
+        # _stopped:
+        self._stopped_at = time.time()
+        self._stopped = True
+        self._stop.set()
+
+    def steps_done(self, t=None):
+        '''Steps started by time t (default now).'''
+        if self.started is None:
+            return 0
+        if self.future.done():
+            return self.future.result()
+        if t is None:
+            t = self._stopped_at if self._stopped else time.time()
+        return min(self.steps, bisect_right(self.schedule, t - self.started))
+
+    def time_of_step(self, n):
+        return self.started + self.schedule[n]
+
+    def position_at(self, t):
+        '''Fractional number of steps completed at time t, interpolated
+        between step edges.'''
+        dt = t - self.started
+        n = bisect_right(self.schedule, dt) - 1
+        if n < 0:
+            return 0.0
+        if n >= self.steps - 1:
+            end = self.duration
+        else:
+            end = self.schedule[n + 1]
+        start = self.schedule[n]
+        return n + min(1.0, (dt - start) / (end - start))
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
 class Stepper:
 
     CLOCKWISE = 0
@@ -27,6 +186,11 @@ class Stepper:
             "ms3":      18,  # GPIO-24
             "enable":   12   # GPIO-18
         },
+        # pigpio numbering, for hardware timed step trains:
+        "gpioBCN": {
+            "step":     16,
+            "dir":      12,
+        },
 
         # without micro-stepping:
         "stepsPerRevolution": 200,  # 1.8 per step
@@ -68,10 +232,11 @@ class Stepper:
 
         # for tracking:
         self._steps = 0
+        self._train = None
+        self.__pi = None
         self._degrees_per_step = (1.0 / self._stepsPerRevolution) * 360
 
-        # logging:
-        print('Stepper values: ', {
+        logger.info('Stepper values: %s', {
             '_stepsPerRevolution': self. _stepsPerRevolution,
             '_stepDelay': self._stepDelay,
             '_direction': self.__direction,
@@ -99,7 +264,28 @@ class Stepper:
             time.sleep(self._stepDelay)
             gpio.output(self._config['gpio']['step'], gpio.LOW)
             time.sleep(self._stepDelay)
-        if self.direction() == self.CLOCKWISE:
+        self.__track(self.direction(), number)
+
+    def run(self, number, rate=None, ramp=0, start_rate=None):
+        '''Step `number` times in the current direction as a hardware timed
+        pulse train and return immediately with the StepTrain. rate is in
+        steps per second and defaults to the speed of step(). Position is
+        updated when the train completes.'''
+        if self._train is not None and not self._train.done():
+            raise RuntimeError('A step train is already running')
+        if self.__pi is None:
+            self.__pi = pi.shared()
+        if rate is None:
+            rate = 1.0 / (2 * self._stepDelay)
+        direction = self.direction()
+        self._train = StepTrain(self.__pi,
+                                self._config['gpioBCN']['step'],
+                                number, rate, ramp, start_rate,
+                                lambda n: self.__track(direction, n))
+        return self._train.start()
+
+    def __track(self, direction, number):
+        if direction == self.CLOCKWISE:
             delta = number
         else:
             delta = -number
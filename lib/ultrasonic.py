@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
+import logging
+import threading
 import time
+import pigpio
 import RPi.GPIO as gpio
 
+from lib import pi
+
+logger = logging.getLogger(__name__)
+
 default_config = {
     'echo': 16,
     'trigger': 12
@@ -23,7 +30,7 @@ class UltraSonic:
 
     def __init__(self, config=default_config):
         self.config = config
-        print("Ultrasonic config:", config)
+        logger.info('Ultrasonic config: %s', config)
         if gpio.getmode() != gpio.BOARD:
             gpio.setmode(gpio.BOARD)
         gpio.setup(self.config['trigger'], gpio.OUT)
@@ -48,6 +55,116 @@ class UltraSonic:
         return distance
 
 
+class UltraSonicArray:
+    '''Ranges several HC-SR04 sensors without polling. Echo edges are
+    timestamped by pigpiod, sensors are triggered one at a time so one
+    sensor's ping is not heard by another, and a missed echo times out
+    instead of hanging. Pins use pigpio numbering.'''
+
+    # speed of sound, cm per microsecond, halved for the round trip:
+    _cm_per_tick = 0.0343 / 2
+
+    _config = {
+        'sensors': {
+            'front': {'trigger': 18, 'echo': 23},  # board 12, 16
+            'back': {'trigger': 25, 'echo': 24},   # board 22, 18
+        },
+        # longest echo is ~38ms when nothing is in range:
+        'timeout': 0.04,
+        # quiet time after each ping so echoes die down:
+        'spacing': 0.02,
+    }
+
+    def __init__(self, config=None):
+        if config:
+            self._config.update(config)
+        logger.info('Ultrasonic array config: %s', self._config)
+        self.__pi = pi.shared()
+        self._sensors = self._config['sensors']
+        self._names = {}
+        self._rise = {}
+        self._echoed = threading.Event()
+        # echo pin of the sensor being ranged; edges on the others are
+        # late echoes of earlier pings:
+        self._ranging = None
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._callbacks = []
+        for name, pins in self._sensors.items():
+            self.__pi.set_mode(pins['trigger'], pigpio.OUTPUT)
+            self.__pi.write(pins['trigger'], 0)
+            self.__pi.set_mode(pins['echo'], pigpio.INPUT)
+            self._names[pins['echo']] = name
+            self._callbacks.append(self.__pi.callback(
+                pins['echo'], pigpio.EITHER_EDGE, self.__edge))
+        self._thread = None
+        self._running = False
+
+    def __edge(self, echo, level, tick):
+        if echo != self._ranging:
+            return
+        if level == 1:
+            self._rise[echo] = tick
+        elif level == 0 and echo in self._rise:
+            width = pigpio.tickDiff(self._rise.pop(echo), tick)
+            self._latest[self._names[echo]] = (
+                width * self._cm_per_tick, time.time())
+            self._echoed.set()
+
+    def ping(self, name):
+        '''Trigger one sensor and wait for its echo. Returns cm, or None if
+        no echo came back in time.'''
+        pins = self._sensors[name]
+        # one sensor at a time, whoever asks:
+        with self._lock:
+            self._echoed.clear()
+            self._rise.pop(pins['echo'], None)
+            self._ranging = pins['echo']
+            sent = time.time()
+            self.__pi.gpio_trigger(pins['trigger'], 10, 1)
+            try:
+                if self._echoed.wait(self._config['timeout']):
+                    latest = self._latest.get(name)
+                    if latest is not None and latest[1] >= sent:
+                        return latest[0]
+            finally:
+                self._ranging = None
+            self._latest[name] = (None, time.time())
+            return None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.__cycle, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._running
+
+    def __cycle(self):
+        while self._running:
+            for name in self._sensors:
+                self.ping(name)
+                time.sleep(self._config['spacing'])
+
+    def latest(self, name):
+        '''(cm, timestamp) of the last ping, cm is None if it timed out'''
+        return self._latest.get(name)
+
+    def close(self):
+        self.stop()
+        for cb in self._callbacks:
+            cb.cancel()
+        pi.release(self.__pi)
+
+
 if __name__ == "__main__":
     ultrasonic = UltraSonic()
     while True:
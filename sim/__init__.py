@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+##########################################################################
+#  Simulated hardware backend
+##########################################################################
+#  install() puts fake versions of RPi.GPIO, pigpio, Adafruit_GPIO.I2C/SPI,
+#  Adafruit_MCP3008 and Adafruit_BNO055 into sys.modules, so the drivers in
+#  lib/ run unchanged on any machine. It has to run before anything
+#  imports those modules. See sim/world.py for what is simulated.
+#
+
+import json
+import sys
+import types
+
+
+def install(config=None):
+    from sim import world, gpio, pigpio, i2c, spi, mcp3008, bno055
+    world.create(config)
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = gpio
+    adafruit_gpio = types.ModuleType('Adafruit_GPIO')
+    adafruit_gpio.I2C = i2c
+    adafruit_gpio.SPI = spi
+    adafruit_bno055 = types.ModuleType('Adafruit_BNO055')
+    adafruit_bno055.BNO055 = bno055
+    sys.modules.update({
+        'RPi': rpi,
+        'RPi.GPIO': gpio,
+        'pigpio': pigpio,
+        'Adafruit_GPIO': adafruit_gpio,
+        'Adafruit_GPIO.I2C': i2c,
+        'Adafruit_GPIO.SPI': spi,
+        'Adafruit_MCP3008': mcp3008,
+        'Adafruit_BNO055': adafruit_bno055,
+        'Adafruit_BNO055.BNO055': bno055,
+    })
+    print("Using simulated hardware.")
+
+
+def select(argv, config_path):
+    '''Install the simulator if --sim was given or the config's backend is
+    "sim". Replaying a recording (--replay) needs no hardware either.
+    Returns True if it was installed.'''
+    try:
+        with open(config_path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = {}
+    if '--sim' in argv or '--replay' in argv \
+            or config.get('backend') == 'sim':
+        install(config.get('sim'))
+        return True
+    return False
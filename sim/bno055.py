@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Stands in for Adafruit_BNO055.BNO055. Heading follows the world's robot
+# pose; the robot is level and still.
+
+import math
+
+from sim.world import world
+
+
+class BNO055:
+
+    def __init__(self, rst=None, address=0x28, i2c=None, gpio=None,
+                 serial_port=None, serial_timeout_sec=5, **kwargs):
+        self._world = world()
+
+    def __read(self, length):
+        self._world.delay('i2c')
+        self._world.delay('i2c_byte', length)
+
+    def begin(self, mode=None):
+        return True
+
+    def get_system_status(self, run_self_test=True):
+        return 0x05, 0x0F, 0x00
+
+    def get_revision(self):
+        return 0x0311, 0x15, 0xFB, 0x32, 0x0F
+
+    def get_calibration_status(self):
+        self.__read(1)
+        return 3, 3, 3, 3
+
+    def read_euler(self):
+        self.__read(6)
+        return self._world.pose[2] % 360, 0.0, 0.0
+
+    def read_quaternion(self):
+        self.__read(8)
+        half = math.radians(self._world.pose[2]) / 2
+        return 0.0, 0.0, math.sin(half), math.cos(half)
+
+    def read_gyroscope(self):
+        self.__read(6)
+        return 0.0, 0.0, 0.0
+
+    def read_accelerometer(self):
+        self.__read(6)
+        return 0.0, 0.0, 9.81
+
+    def read_temp(self):
+        self.__read(1)
+        return 25
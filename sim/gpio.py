@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Stands in for RPi.GPIO.
+
+from sim.world import world, BOARD_TO_BCM
+
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+
+_mode = None
+
+
+def setmode(mode):
+    global _mode
+    _mode = mode
+
+
+def getmode():
+    return _mode
+
+
+def setwarnings(flag):
+    pass
+
+
+def _bcm(pin):
+    if _mode == BOARD:
+        return BOARD_TO_BCM[pin]
+    return pin
+
+
+def _each(pins):
+    if isinstance(pins, (list, tuple)):
+        return list(pins)
+    return [pins]
+
+
+def setup(pins, direction, pull_up_down=PUD_OFF, initial=None):
+    if initial is not None:
+        output(pins, initial)
+
+
+def output(pins, values):
+    pins = _each(pins)
+    if isinstance(values, (list, tuple)):
+        values = list(values)
+    else:
+        values = [values] * len(pins)
+    w = world()
+    for pin, value in zip(pins, values):
+        w.delay('gpio')
+        w.write(_bcm(pin), value)
+
+
+def input(pin):
+    w = world()
+    w.delay('gpio')
+    return w.read(_bcm(pin))
+
+
+def cleanup(pins=None):
+    pass
+
+
+class PWM:
+
+    def __init__(self, pin, frequency):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0
+
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.duty_cycle = 0
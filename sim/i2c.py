@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Stands in for Adafruit_GPIO.I2C. Address 0x62 is a Garmin LIDAR-Lite V3
+# looking into the world's room; other addresses read back zeros.
+
+from sim.world import world
+
+LIDAR_ADDRESS = 0x62
+
+
+class Device:
+
+    def __init__(self, address, busnum=1):
+        self.address = address
+        self._world = world()
+        self._registers = bytearray(256)
+
+    def __transfer(self, length):
+        self._world.delay('i2c')
+        self._world.delay('i2c_byte', length)
+
+    def _update(self):
+        pass
+
+    def write8(self, register, value):
+        self.__transfer(2)
+        self._registers[register & 0x7F] = value & 0xFF
+
+    def readU8(self, register):
+        self.__transfer(1)
+        self._update()
+        return self._registers[register & 0x7F]
+
+    def readS8(self, register):
+        value = self.readU8(register)
+        return value - 256 if value > 127 else value
+
+    def readList(self, register, length):
+        self.__transfer(length)
+        self._update()
+        start = register & 0x7F
+        return bytearray(self._registers[start:start + length])
+
+
+class Lidar(Device):
+    '''Takes a new measurement every MEASURE_DELAY / 2000 seconds and
+    reports busy while the last ~0.3ms of each one is in progress.'''
+
+    _acquisition = 0.0003
+
+    def __init__(self, address, busnum=1):
+        Device.__init__(self, address, busnum)
+        self._last = None
+        self._distance = 0
+
+    def _update(self):
+        delay = self._registers[0x45] or 0x14
+        period = delay / 2000.0
+        now = self._world.clock.now()
+        phase = now % period
+        busy = phase > period - self._acquisition
+        sample = int(now / period)
+        if sample != self._last:
+            distance = int(round(self._world.lidar_range()))
+            # velocity register: cm moved since the last measurement
+            velocity = max(-128, min(127, self._distance - distance))
+            self._distance = distance
+            self._last = sample
+            self._registers[0x09] = velocity & 0xFF
+            self._registers[0x0F] = (distance >> 8) & 0xFF
+            self._registers[0x10] = distance & 0xFF
+        self._registers[0x01] = 0x01 if busy else 0x00
+
+
+def get_i2c_device(address, busnum=None, i2c_interface=None, **kwargs):
+    if address == LIDAR_ADDRESS:
+        return Lidar(address)
+    return Device(address)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+# Stands in for Adafruit_MCP3008. Channels configured under the world's
+# 'ir' read back the value a Sharp 10-80cm sensor gives at that distance.
+
+import random
+
+from sim.world import world
+
+
+class MCP3008:
+
+    def __init__(self, clk=None, cs=None, miso=None, mosi=None, spi=None,
+                 gpio=None):
+        self._spi = spi
+
+    def read_adc(self, adc_number):
+        w = world()
+        w.delay('spi')
+        cm = w.config['ir'].get(adc_number)
+        if not cm:
+            return 0
+        cm += random.gauss(0, w.config['noise'])
+        # inverse of cm = 12343.85 * value ** -1.15
+        value = (12343.85 / max(1.0, cm)) ** (1 / 1.15)
+        return max(0, min(1023, int(round(value))))
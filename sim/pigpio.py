@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# Stands in for pigpio. Every call pays one modeled round trip to pigpiod.
+
+import threading
+
+from sim.world import world
+
+INPUT = 0
+OUTPUT = 1
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+
+def tickDiff(t1, t2):
+    return (t2 - t1) & 0xFFFFFFFF
+
+
+class pulse:
+
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+
+class _callback:
+
+    def __init__(self, pi, gpio, edge, func):
+        self._pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+    def __call__(self, gpio, level):
+        if not self.active:
+            return
+        if self.edge == EITHER_EDGE or \
+                (self.edge == RISING_EDGE and level) or \
+                (self.edge == FALLING_EDGE and not level):
+            self.func(gpio, level, self._pi.get_current_tick())
+
+
+class pi:
+
+    def __init__(self, host='localhost', port=8888):
+        self.connected = True
+        self._world = world()
+        self._pending = []
+        self._waves = {}
+        self._next_wave = 0
+        self._modes = {}
+        self._pwm = {}
+        self._frequency = {}
+
+    def __trip(self):
+        self._world.delay('pigpio')
+
+    def stop(self):
+        self.__trip()
+        self.connected = False
+
+    def get_current_tick(self):
+        return int(self._world.clock.now() * 1000000) & 0xFFFFFFFF
+
+    def set_mode(self, gpio, mode):
+        self.__trip()
+        self._modes[gpio] = mode
+
+    def write(self, gpio, level):
+        self.__trip()
+        self._world.write(gpio, level)
+
+    def read(self, gpio):
+        self.__trip()
+        return self._world.read(gpio)
+
+    def set_bank_1(self, bits):
+        self.__trip()
+        for gpio in range(32):
+            if bits & (1 << gpio):
+                self._world.write(gpio, 1)
+
+    def clear_bank_1(self, bits):
+        self.__trip()
+        for gpio in range(32):
+            if bits & (1 << gpio):
+                self._world.write(gpio, 0)
+
+    def set_PWM_frequency(self, gpio, frequency):
+        self.__trip()
+        self._frequency[gpio] = frequency
+        return frequency
+
+    def set_PWM_dutycycle(self, gpio, duty_cycle):
+        self.__trip()
+        self._pwm[gpio] = duty_cycle
+
+    def get_PWM_dutycycle(self, gpio):
+        self.__trip()
+        return self._pwm.get(gpio, 0)
+
+    def set_servo_pulsewidth(self, gpio, pulse_width):
+        self.__trip()
+        if gpio == self._world.config['servo']['gpio']:
+            self._world.set_servo(pulse_width)
+        self._pwm[gpio] = pulse_width
+
+    def get_servo_pulsewidth(self, gpio):
+        self.__trip()
+        return self._pwm.get(gpio, 0)
+
+    def callback(self, gpio, edge=RISING_EDGE, func=None):
+        self.__trip()
+        cb = _callback(self, gpio, edge, func)
+        self._world.listen(gpio, cb)
+        return cb
+
+    def gpio_trigger(self, gpio, pulse_len=10, level=1):
+        '''Pings an ultrasonic sensor when gpio is one of its triggers.'''
+        self.__trip()
+        sensor = self._world.config['ultrasonic'].get(gpio)
+        if sensor is None:
+            return
+        distance = self._world.range(sensor['bearing'])
+        # sound goes there and back at 34300 cm/s:
+        width = 2 * distance / 34300.0
+        if width > 0.038:
+            return  # nothing in range, no echo
+
+        def echo():
+            self._world.clock.sleep(0.0005)
+            self._world.write(sensor['echo'], 1)
+            self._world.clock.sleep(width)
+            self._world.write(sensor['echo'], 0)
+        threading.Thread(target=echo, daemon=True).start()
+
+    # waveforms:
+
+    def wave_clear(self):
+        self.__trip()
+        self._waves = {}
+        self._pending = []
+
+    def wave_add_generic(self, pulses):
+        self.__trip()
+        self._pending.extend(pulses)
+        return len(self._pending)
+
+    def wave_create(self):
+        self.__trip()
+        steps = sum(1 for p in self._pending
+                    if p.gpio_on & (1 << self._world.config['stepper']['step']))
+        micros = sum(p.delay for p in self._pending)
+        wid = self._next_wave
+        self._next_wave += 1
+        self._waves[wid] = (steps, micros)
+        self._pending = []
+        return wid
+
+    def wave_delete(self, wave_id):
+        self.__trip()
+        self._waves.pop(wave_id, None)
+
+    def wave_chain(self, data):
+        self.__trip()
+        steps, micros = self.__play(list(data))
+        self._world.start_train(steps, micros / 1000000.0)
+
+    def __play(self, data):
+        '''Total (steps, micros) of a chain, expanding loops.'''
+        steps = micros = 0
+        i = 0
+        while i < len(data):
+            if data[i] == 255 and data[i + 1] == 0:
+                # loop start ... 255 1 x y
+                end = i + 2
+                depth = 0
+                while not (data[end] == 255 and data[end + 1] == 1
+                           and depth == 0):
+                    if data[end] == 255 and data[end + 1] == 0:
+                        depth += 1
+                        end += 2
+                    elif data[end] == 255 and data[end + 1] == 1:
+                        depth -= 1
+                        end += 4
+                    else:
+                        end += 1
+                s, m = self.__play(data[i + 2:end])
+                loops = data[end + 2] + (data[end + 3] << 8)
+                steps += s * loops
+                micros += m * loops
+                i = end + 4
+            else:
+                s, m = self._waves[data[i]]
+                steps += s
+                micros += m
+                i += 1
+        return steps, micros
+
+    def wave_send_once(self, wave_id):
+        self.__trip()
+        steps, micros = self._waves[wave_id]
+        self._world.start_train(steps, micros / 1000000.0)
+
+    def wave_tx_busy(self):
+        self.__trip()
+        busy = self._world.train_busy()
+        if not busy:
+            self._world.finish_train()
+        return 1 if busy else 0
+
+    def wave_tx_stop(self):
+        self.__trip()
+        self._world.finish_train()
+
+    def wave_get_max_pulses(self):
+        return 12000
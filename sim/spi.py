@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+# Stands in for Adafruit_GPIO.SPI.
+
+from sim.world import world
+
+
+class SpiDev:
+
+    def __init__(self, port, device, max_speed_hz=500000):
+        self.port = port
+        self.device = device
+        self.max_speed_hz = max_speed_hz
+
+    def set_clock_hz(self, hz):
+        self.max_speed_hz = hz
+
+    def set_mode(self, mode):
+        pass
+
+    def set_bit_order(self, order):
+        pass
+
+    def transfer(self, data):
+        world().delay('spi')
+        return bytearray(len(data))
+
+    def close(self):
+        pass
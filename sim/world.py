@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import math
+import random
+import threading
+import time
+from collections import deque
+
+##########################################################################
+#  Simulated robot
+##########################################################################
+#  One World is shared by the fake hardware modules. It holds the state of
+#  every pin (pigpio/BCM numbering), a bounded history of pin changes, the
+#  roof mount's pan and tilt as driven by the step/dir pins and the servo
+#  pulse width, and a 2D room the lidar and distance sensors look into.
+#
+#  The simulated devices run at `speed` times real time: their latencies
+#  are divided by it, and now() advances that much faster. The drivers in
+#  lib/ still pace themselves on time.time() and time.sleep(), so this
+#  does not speed up a whole run; above 1 it makes the devices cheaper
+#  (for profiling the Python around them) and their own timelines, such as
+#  step trains and lidar measurements, run ahead of the drivers. Keep it
+#  at 1 when timing matters.
+#
+
+# RPi.GPIO BOARD pin -> BCM gpio
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22,
+    16: 23, 18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0,
+    28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20,
+    40: 21,
+}
+
+default_config = {
+    'speed': 1.0,
+    # seconds, before dividing by speed:
+    'latency': {
+        'gpio': 0.000005,
+        'pigpio': 0.0001,
+        'i2c': 0.0002,
+        'i2c_byte': 0.00009,
+        'spi': 0.00003,
+    },
+    'history': 100000,
+    'stepper': {
+        'step': 16,
+        'dir': 12,
+        'stepsPerRevolution': 3200,
+    },
+    'servo': {
+        'gpio': 26,
+        'level_degrees': 35,
+        'right': 500,
+        'left': 2500,
+    },
+    # cm; the robot sits at (x, y) facing heading degrees, counter-
+    # clockwise from the room's x axis:
+    'room': {
+        'width': 400,
+        'length': 600,
+        'obstacles': [[300, 150, 30]],  # x, y, radius
+    },
+    'robot': [150, 200, 0],
+    'noise': 1.0,
+    'maxRange': 4000,
+    'ir': {2: 35.0},  # adc channel -> cm
+    'ultrasonic': {
+        # trigger gpio -> echo gpio and bearing (degrees clockwise)
+        18: {'echo': 23, 'bearing': 0},
+        25: {'echo': 24, 'bearing': 180},
+    },
+}
+
+
+class Clock:
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._start = time.time()
+
+    def now(self):
+        return self._start + (time.time() - self._start) * self.speed
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+
+class World:
+
+    def __init__(self, config=None):
+        self.config = dict(default_config)
+        if config:
+            self.config.update(config)
+        # JSON keys are strings:
+        self.config['ir'] = {int(k): v for k, v in self.config['ir'].items()}
+        self.config['ultrasonic'] = {
+            int(k): v for k, v in self.config['ultrasonic'].items()}
+        self.clock = Clock(self.config['speed'])
+        self.latency = self.config['latency']
+        self.pins = {}
+        self.history = deque(maxlen=self.config['history'])
+        self._lock = threading.Lock()
+        self._listeners = {}
+        # roof mount:
+        self.steps = 0
+        self._train = None
+        self.servo_pulse_width = 0
+        self.servo_degrees = 0.0
+        x, y, heading = self.config['robot']
+        self.pose = [float(x), float(y), float(heading)]
+
+    def delay(self, kind, n=1):
+        self.clock.sleep(self.latency[kind] * n)
+
+    # pins:
+
+    def write(self, pin, level):
+        level = 1 if level else 0
+        with self._lock:
+            old = self.pins.get(pin, 0)
+            self.pins[pin] = level
+            self.history.append((self.clock.now(), pin, level))
+        if level != old:
+            self.__edge(pin, level)
+            for listener in self._listeners.get(pin, ()):
+                listener(pin, level)
+
+    def read(self, pin):
+        return self.pins.get(pin, 0)
+
+    def listen(self, pin, listener):
+        self._listeners.setdefault(pin, []).append(listener)
+
+    def __edge(self, pin, level):
+        stepper = self.config['stepper']
+        if pin == stepper['step'] and level:
+            self.steps += self.__step_sign()
+
+    def __step_sign(self):
+        # Stepper.CLOCKWISE is 0 on the dir pin
+        return -1 if self.read(self.config['stepper']['dir']) else 1
+
+    # roof mount:
+
+    def start_train(self, steps, duration):
+        '''A pigpio waveform of `steps` step pulses over `duration`.'''
+        self.finish_train()
+        self._train = (self.clock.now(), steps, duration, self.__step_sign())
+
+    def finish_train(self):
+        if self._train is not None:
+            self.steps += self.__train_progress()
+            self._train = None
+
+    def __train_progress(self):
+        started, steps, duration, sign = self._train
+        if duration <= 0:
+            return sign * steps
+        done = min(1.0, (self.clock.now() - started) / duration)
+        return sign * int(steps * done)
+
+    def train_busy(self):
+        if self._train is None:
+            return False
+        started, steps, duration, sign = self._train
+        return self.clock.now() < started + duration
+
+    def set_servo(self, pulse_width):
+        self.servo_pulse_width = pulse_width
+        servo = self.config['servo']
+        if pulse_width:
+            self.servo_degrees = (pulse_width - servo['right']) * 180 / \
+                (servo['left'] - servo['right']) - 90
+
+    def azimuth(self):
+        '''Pan, degrees clockwise from the robot's heading'''
+        steps = self.steps
+        if self._train is not None:
+            steps += self.__train_progress()
+        return steps * 360.0 / self.config['stepper']['stepsPerRevolution']
+
+    def elevation(self):
+        '''Tilt, degrees above the horizon'''
+        return self.config['servo']['level_degrees'] - self.servo_degrees
+
+    # room:
+
+    def range(self, bearing, elevation=0.0):
+        '''Distance in cm along a ray `bearing` degrees clockwise from the
+        robot's heading, tilted `elevation` degrees up.'''
+        x, y, heading = self.pose
+        a = math.radians(heading - bearing)
+        dx, dy = math.cos(a), math.sin(a)
+        room = self.config['room']
+        hits = []
+        if dx > 0:
+            hits.append((room['width'] - x) / dx)
+        elif dx < 0:
+            hits.append(-x / dx)
+        if dy > 0:
+            hits.append((room['length'] - y) / dy)
+        elif dy < 0:
+            hits.append(-y / dy)
+        for ox, oy, r in room['obstacles']:
+            # ray / circle:
+            fx, fy = x - ox, y - oy
+            b = fx * dx + fy * dy
+            c = fx * fx + fy * fy - r * r
+            disc = b * b - c
+            if disc >= 0:
+                t = -b - math.sqrt(disc)
+                if t > 0:
+                    hits.append(t)
+        flat = min(hits) if hits else self.config['maxRange']
+        cos = math.cos(math.radians(elevation))
+        distance = flat / cos if cos > 0.01 else self.config['maxRange']
+        distance += random.gauss(0, self.config['noise'])
+        return max(0.0, min(self.config['maxRange'], distance))
+
+    def lidar_range(self):
+        return self.range(self.azimuth(), self.elevation())
+
+
+_world = None
+
+
+def world():
+    global _world
+    if _world is None:
+        _world = World()
+    return _world
+
+
+def create(config=None):
+    global _world
+    _world = World(config)
+    return _world
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from util import scanframe
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    i = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[i]
+
+
+def measure(fn, iterations, warmup=10, units=1, before=None):
+    '''Time fn() over many iterations. units is how many steps, samples,
+    etc. one call does, for the throughput figure. before(), if given, is
+    called ahead of each call and not timed. Allocation figures come from
+    a second, traced pass so tracing does not skew the timings.'''
+    for i in range(min(warmup, iterations // 10)):
+        if before is not None:
+            before()
+        fn()
+    latencies = []
+    total = 0.0
+    for i in range(iterations):
+        if before is not None:
+            before()
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+        total += latencies[-1]
+    latencies.sort()
+
+    traced = max(1, min(iterations, 100))
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    peak = 0
+    for i in range(traced):
+        if before is not None:
+            before()
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak += tracemalloc.get_traced_memory()[1] - traced_before
+    retained = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'throughput_per_s': iterations * units / total,
+        'peak_bytes_per_op': peak / traced,
+        'retained_blocks_per_op': retained / traced,
+    }
+
+
+@contextmanager
+def _paused(lidar):
+    '''Stop the lidar's background sampling for a while, so a benchmark
+    has the sensor and the bus to itself'''
+    running = lidar.running()
+    if running:
+        lidar.stop()
+    try:
+        yield
+    finally:
+        if running:
+            lidar.start()
+
+
+def _paced(lidar):
+    '''(before, read) taking one sample per period of the lidar's rate,
+    with the wait before each read left out of the timings'''
+    period = 1.0 / lidar.rate
+    last = [0.0]
+
+    def before():
+        wait = last[0] + period - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def read():
+        lidar.read()
+        last[0] = time.time()
+    return before, read
+
+
+def benchmarks(hal):
+    '''(name, fn, iterations, units, unit, before, context) for each hot
+    path the hal has hardware for. before is called ahead of each
+    iteration, untimed; context, if not None, is entered around the
+    benchmark.'''
+    out = []
+
+    def add(name, fn, iterations, units, unit, before=None, context=None):
+        out.append((name, fn, iterations, units, unit, before, context))
+    roofmount = hal._roofmount
+    if roofmount is not None:
+        from lib.lidar import Lidar
+        stepper = roofmount._stepper
+        lidar = roofmount._lidar
+        add('stepper.step', stepper.step, 2000, 1, 'steps')
+
+        # a worker process proxy reads in another process; it has no
+        # read modes to compare:
+        if isinstance(lidar, Lidar):
+            for mode, block in (('block', True), ('registers', False)):
+                with _paused(lidar):
+                    own = Lidar(rate=lidar.rate, buffer_size=1,
+                                block_read=block, metrics=False)
+                before, read = _paced(own)
+                add('lidar.read.' + mode, read, 500, 1, 'samples',
+                    before, lambda: _paused(lidar))
+        add('lidar.latest', lidar.latest, 10000, 1, 'samples')
+        add('roofmount.get_readings', roofmount.get_readings, 500, 1,
+            'readings')
+        add('roofmount.horizontal_scan',
+            lambda: roofmount.horizontal_scan(0, 0.1), 3, 1, 'scans')
+
+        reading = {
+            'vertical_position': 0.0, 'horizontal_position': 12.5,
+            'lidar': 250, 'velocity': -3, 'step': 111,
+            'timestamp': time.time(),
+        }
+        frames = scanframe.ScanFrameWriter(lambda data: None, 0.0)
+        add('scan.encode.json', lambda: json.dumps(reading), 20000, 1,
+            'readings')
+        add('scan.encode.binary', lambda: frames.add(reading), 20000, 1,
+            'readings')
+    if hal._orientation is not None:
+        add('hal.get_orientation.json',
+            lambda: json.dumps(hal.get_orientation()), 200, 1, 'readings')
+    add('hal.get_readings.json', lambda: json.dumps(hal.get_readings()),
+        500, 1, 'readings')
+    return out
+
+
+def run(hal, path=None, backend='hardware'):
+    '''Run every benchmark, print a summary and write the results as JSON
+    to path.'''
+    report = {
+        'timestamp': time.time(),
+        'backend': backend,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': {},
+    }
+    for name, fn, iterations, units, unit, before, context in \
+            benchmarks(hal):
+        if context is None:
+            result = measure(fn, iterations, units=units, before=before)
+        else:
+            with context():
+                result = measure(fn, iterations, units=units, before=before)
+        result['unit'] = unit
+        report['results'][name] = result
+        print('%-28s p50 %9.4fms  p95 %9.4fms  p99 %9.4fms  %12.1f %s/s'
+              % (name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                 result['throughput_per_s'], unit))
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to ' + path)
+    return report
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import inspect
+import json
+
+NUMBER = (int, float)
+
+
+class CommandError(Exception):
+    pass
+
+
+class Request:
+    '''One decoded command and where its replies go. Every reply echoes the
+    command's id, if it had one.'''
+
+    def __init__(self, cmd, conn):
+        self.cmd = cmd
+        self.conn = conn
+        # anything that is not an object is rejected by Dispatcher.lookup,
+        # with a reply that has no id:
+        self.id = cmd.get('id') if isinstance(cmd, dict) else None
+
+    def reply(self, msg):
+        if self.id is not None:
+            msg['id'] = self.id
+        self.send(json.dumps(msg))
+
+    def send(self, text):
+        if self.conn is None:
+            print(text)
+        else:
+            self.conn.send(text)
+
+    def send_bytes(self, data):
+        self.conn.send_bytes(data)
+
+
+class Command:
+
+    def __init__(self, name, handler, required, optional, exclusive):
+        self.name = name
+        self.handler = handler
+        self.required = required
+        self.optional = optional
+        self.exclusive = exclusive
+
+    def arguments(self, cmd):
+        args = {}
+        for name, kind in self.required:
+            if name not in cmd:
+                raise CommandError('missing argument: ' + name)
+            args[name] = self.__check(name, kind, cmd[name])
+        for name, kind, default in self.optional:
+            if name in cmd:
+                args[name] = self.__check(name, kind, cmd[name])
+            else:
+                args[name] = default
+        return args
+
+    def __check(self, name, kind, value):
+        # bool is an int, but never a sensible number here:
+        if not isinstance(value, kind) or \
+                (isinstance(value, bool) and kind is not bool):
+            raise CommandError('bad argument: ' + name)
+        return value
+
+
+class Dispatcher:
+    '''Maps command names to handlers. Argument specs are checked against
+    the handler's signature when it is registered, so a request only has
+    to be matched against a precomputed list.
+
+    Handlers are called as handler(request, **arguments). Exclusive
+    commands drive hardware and are run one at a time, in order; the rest
+    only read cached state and may run alongside them.'''
+
+    def __init__(self):
+        self._commands = {}
+
+    def register(self, name, handler, required=None, optional=None,
+                 exclusive=True):
+        '''required maps argument name to type(s); optional maps argument
+        name to (type(s), default).'''
+        if name in self._commands:
+            raise ValueError('command already registered: ' + name)
+        required = list((required or {}).items())
+        optional = [(n, kind, default)
+                    for n, (kind, default) in (optional or {}).items()]
+        params = inspect.signature(handler).parameters
+        takes_any = any(p.kind == p.VAR_KEYWORD for p in params.values())
+        for n, kind in required + [(n, k) for n, k, d in optional]:
+            if not takes_any and n not in params:
+                raise ValueError(name + ' handler does not take ' + n)
+            if not isinstance(kind, (type, tuple)):
+                raise ValueError(name + ' argument ' + n + ' needs a type')
+        self._commands[name] = Command(name, handler, required, optional,
+                                       exclusive)
+
+    def lookup(self, cmd):
+        '''The Command for a decoded message, and its arguments'''
+        if not isinstance(cmd, dict) or 'command' not in cmd:
+            raise CommandError('no command')
+        command = self._commands.get(cmd['command'])
+        if command is None:
+            raise CommandError('unknown command: ' + str(cmd['command']))
+        return command, command.arguments(cmd)
+
+    def names(self):
+        return sorted(self._commands)
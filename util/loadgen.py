@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+##########################################################################
+#  Load generator for the command server
+##########################################################################
+#  Opens N connections and sends a weighted mix of commands on each at a
+#  target rate, without waiting for replies (up to --pipeline in flight).
+#  Replies are matched by id to get round trip times. Run it against a
+#  bot, or against `hal.py --network --sim` on localhost:
+#
+#    python3 -m util.loadgen --connections 4 --rate 20 --duration 10 \
+#        --mix get_readings=5,get_orientation=5,isready=1,horizontal_scan=0.1
+#
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from util import scanframe
+
+COMMANDS = {
+    'isready': {'command': 'isready'},
+    'get_readings': {'command': 'get_readings'},
+    'get_orientation': {'command': 'get_orientation'},
+    # no reply; only counted as sent:
+    'move': {'command': 'move', 'direction': 'forward', 'time': 0.05,
+             'speed': 0},
+    'horizontal_scan': {'command': 'horizontal_scan',
+                        'vertical_position': 0, 'resolution': 0.1,
+                        'encoding': 'binary'},
+}
+
+NO_REPLY = {'move'}
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return None
+    i = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[i]
+
+
+class Stats:
+
+    def __init__(self):
+        self.sent = {}
+        self.rtts = {}
+        self.errors = 0
+        self.misordered = 0
+        self.scan_bytes = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def report(self, duration):
+        commands = {}
+        for name, count in self.sent.items():
+            rtts = sorted(self.rtts.get(name, []))
+            commands[name] = {
+                'sent': count,
+                'replies': len(rtts),
+                'per_s': len(rtts) / duration,
+                'p50_ms': _ms(_percentile(rtts, 50)),
+                'p95_ms': _ms(_percentile(rtts, 95)),
+                'p99_ms': _ms(_percentile(rtts, 99)),
+                'max_ms': _ms(rtts[-1] if rtts else None),
+            }
+        return {
+            'duration': duration,
+            'commands': commands,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'misordered': self.misordered,
+            'bytes_per_s': self.bytes / duration,
+            'scan_bytes_per_s': self.scan_bytes / duration,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class Client:
+
+    def __init__(self, number, args, mix, stats):
+        self.number = number
+        self.args = args
+        self.mix = mix
+        self.stats = stats
+        self.pending = {}
+        # ids in the order sent, per command; reads may overtake queued
+        # hardware commands, but replies to the same command should not
+        # overtake each other:
+        self.order = {}
+        self.next_id = 0
+        self.slots = asyncio.Semaphore(args.pipeline)
+
+    async def run(self, deadline):
+        reader, writer = await asyncio.open_connection(
+            self.args.host, self.args.port)
+        receiving = asyncio.ensure_future(self.receive(reader))
+        names, weights = zip(*self.mix)
+        period = 1.0 / self.args.rate
+        next_send = time.time()
+        while time.time() < deadline:
+            name = random.choices(names, weights)[0]
+            cmd = dict(COMMANDS[name])
+            self.stats.sent[name] = self.stats.sent.get(name, 0) + 1
+            if name not in NO_REPLY:
+                await self.slots.acquire()
+                self.next_id += 1
+                cmd['id'] = '%d-%d' % (self.number, self.next_id)
+                self.pending[cmd['id']] = (name, time.time())
+                self.order.setdefault(name, []).append(cmd['id'])
+            writer.write((json.dumps(cmd) + '\n').encode())
+            await writer.drain()
+            next_send += period
+            await asyncio.sleep(max(0, next_send - time.time()))
+        # give outstanding replies a chance:
+        grace = time.time() + self.args.grace
+        while self.pending and time.time() < grace:
+            await asyncio.sleep(0.01)
+        self.stats.dropped += len(self.pending)
+        receiving.cancel()
+        writer.close()
+
+    async def receive(self, reader):
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                if first == b'{':
+                    line = first + await reader.readline()
+                    self.stats.bytes += len(line)
+                    self.reply(json.loads(line))
+                    continue
+                header = first + await reader.readexactly(
+                    scanframe.HEADER.size - 1)
+                magic, version, flags, count, vertical = \
+                    scanframe.HEADER.unpack(header)
+                if magic == scanframe.MAGIC:
+                    size = scanframe.RECORD.size
+                elif magic == scanframe.POINTS_MAGIC:
+                    size = scanframe.POINT.size
+                else:
+                    raise ValueError('Unexpected bytes from server')
+                await reader.readexactly(count * size)
+                n = len(header) + count * size
+                self.stats.bytes += n
+                self.stats.scan_bytes += n
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def reply(self, msg):
+        id = msg.get('id')
+        if id not in self.pending:
+            return  # telemetry, or a reply we gave up on
+        name, sent = self.pending[id]
+        if 'error' in msg:
+            self.stats.errors += 1
+        elif name == 'horizontal_scan' and msg.get('status') != 'complete':
+            self.stats.scan_bytes += len(json.dumps(msg))
+            return  # a reading; the scan is not done yet
+        del self.pending[id]
+        self.stats.rtts.setdefault(name, []).append(time.time() - sent)
+        order = self.order[name]
+        if order[0] != id:
+            self.stats.misordered += 1
+        order.remove(id)
+        self.slots.release()
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in COMMANDS:
+            raise ValueError('unknown command in mix: ' + name)
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+async def main(args):
+    mix = parse_mix(args.mix)
+    stats = Stats()
+    start = time.time()
+    deadline = start + args.duration
+    await asyncio.gather(*[Client(n, args, mix, stats).run(deadline)
+                           for n in range(args.connections)])
+    return stats.report(time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9091)
+    parser.add_argument('--connections', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=10,
+                        help='commands per second per connection')
+    parser.add_argument('--pipeline', type=int, default=8,
+                        help='most replies outstanding per connection')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--grace', type=float, default=5,
+                        help='seconds to wait for replies at the end')
+    parser.add_argument('--mix', default='isready=1,get_readings=4,'
+                        'get_orientation=4,move=1')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+    report = asyncio.run(main(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
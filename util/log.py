@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+##########################################################################
+#  Logging
+##########################################################################
+#  Modules log through logging.getLogger(__name__) as usual. setup() puts a
+#  queue between the loggers and the console, so the thread that logs only
+#  pays for a level check, merging the arguments into the message and a
+#  queue put; the rest of the formatting and the (possibly slow: SSH,
+#  serial console) write happen on a background thread. Each
+#  message template is rate limited, so a failing sensor read in a loop
+#  does not flood the console, and long messages are truncated.
+#
+
+_defaults = {
+    'level': 'INFO',
+    # per logger level overrides, e.g. {"hal": "DEBUG"}:
+    'levels': {},
+    # most records of one message template per interval; 0 for no limit:
+    'ratePerSecond': 10,
+    'maxLength': 200,
+    'queueSize': 10000,
+}
+
+_listener = None
+_config = None
+
+
+class RateLimit(logging.Filter):
+    '''Let through at most `rate` records per second for each message
+    template, and report how many were dropped on the next one let through.
+    Templates are compared before formatting, so 'Handling %s' is one
+    template whatever the payload.'''
+
+    def __init__(self, rate):
+        super().__init__()
+        self._rate = rate
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self._rate:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= 1.0:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self._rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class Formatter(logging.Formatter):
+    '''Truncates the message, and notes records dropped by RateLimit'''
+
+    def __init__(self, max_length):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self._max_length = max_length
+
+    def formatMessage(self, record):
+        if self._max_length and len(record.message) > self._max_length:
+            record.message = record.message[:self._max_length] + \
+                '... (%d chars)' % len(record.message)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            record.message += ' (%d similar suppressed)' % suppressed
+        return super().formatMessage(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # the arguments may be objects the caller goes on changing (config
+        # dicts, for one), so merge them into the message now; the rate
+        # limit has already seen the template. Timestamps, truncation and
+        # the console write are left to the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # tracebacks hold on to frames that may change too:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass  # never block a control loop on the console
+
+
+def setup(config=None):
+    '''Route all logging through a queue to stderr. config is the
+    "logging" section of config.json.'''
+    global _listener, _config
+    _config = config
+    settings = dict(_defaults)
+    if config:
+        settings.update(config)
+    if _listener is not None:
+        _listener.stop()
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(Formatter(settings['maxLength']))
+    q = queue.Queue(settings['queueSize'])
+    handler = _QueueHandler(q)
+    handler.addFilter(RateLimit(settings['ratePerSecond']))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(settings['level'])
+    for name, level in settings['levels'].items():
+        logging.getLogger(name).setLevel(level)
+    _listener = logging.handlers.QueueListener(q, console)
+    _listener.start()
+    atexit.unregister(shutdown)
+    atexit.register(shutdown)
+
+
+def shutdown():
+    '''Write out whatever is still queued'''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork():
+    # the listener thread is not copied into a forked child (see
+    # util/workers.py), so it needs its own:
+    global _listener
+    if _listener is not None:
+        _listener = None
+        setup(_config)
+
+
+os.register_at_fork(after_in_child=_after_fork)
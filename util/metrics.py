@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+##########################################################################
+#  Runtime metrics
+##########################################################################
+#  Counters and latency histograms kept in fixed size buckets, so recording
+#  is a couple of integer adds and memory never grows. Histogram buckets
+#  double in width from 10us up to ~80s. Everything is reachable from the
+#  module level `registry`.
+#
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+
+    # upper bounds, in seconds:
+    bounds = [0.00001 * 2 ** i for i in range(24)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # linear search is cheaper than bisect for the usual short times:
+        i = 0
+        bounds = self.bounds
+        while i < len(bounds) and seconds > bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def time(self):
+        '''with histogram.time(): ...'''
+        return _Timer(self)
+
+    def percentile(self, p):
+        '''Upper bound of the bucket holding the p'th percentile, or the
+        largest value seen if that is lower'''
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000,
+        }
+
+
+class _Timer:
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.record(time.perf_counter() - self._start)
+        return False
+
+
+class Registry:
+    '''Named metrics, created on first use. Gauges are functions read when
+    a snapshot is taken, for values other modules already keep.'''
+
+    def __init__(self):
+        self._metrics = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def __get(self, name, kind):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, kind())
+        return metric
+
+    def counter(self, name):
+        return self.__get(name, Counter)
+
+    def histogram(self, name):
+        return self.__get(name, Histogram)
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def remove(self, prefix):
+        with self._lock:
+            for name in [n for n in self._metrics if n.startswith(prefix)]:
+                del self._metrics[name]
+
+    def snapshot(self):
+        out = {'uptime': time.time() - self.started}
+        for name, metric in sorted(self._metrics.items()):
+            out[name] = metric.snapshot()
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                out[name] = fn()
+            except Exception as e:
+                out[name] = str(e)
+        return out
+
+
+registry = Registry()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import bisect
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+##########################################################################
+#  Session recording
+##########################################################################
+#  A recording is three files next to each other:
+#
+#    <path>.rec   a header, then fixed width records in file order
+#    <path>.idx   per chunk of `chunk` records, the lowest and highest
+#                 timestamp in it, as pairs of doubles
+#    <path>.txt   JSON lines: the first holds metadata (channel names,
+#                 mount geometry), the rest the commands referenced by
+#                 COMMAND records
+#
+#  Header (little endian):
+#
+#    magic    6s  b'HALREC'
+#    version  H   1
+#    chunk    I   records per chunk
+#
+#  Record, 28 bytes:
+#
+#    timestamp  d   seconds since the epoch
+#    kind       B   one of the kinds below
+#    channel    B   sensor index for IR and ULTRASONIC, scan id for SCAN
+#    aux        H   step for SCAN, otherwise 0
+#    values     4f  see kinds; NaN where a sensor had no reading
+#
+#  COMMAND records hold the byte offset and length of the command in the
+#  .txt file in place of the values (COMMAND_REF layout, same width).
+#
+#  Records are appended in the order they reach the recorder, which is
+#  only roughly time order across sensors; the index keeps both ends of
+#  each chunk so seeking stays correct.
+#
+#  The records of the chunk being filled are written out every
+#  `flush_interval` seconds, but its index entry only once it is full (or
+#  the recording is closed), so chunk n always starts at record n * chunk.
+#  A recording cut short by a crash has more records than its index
+#  covers; Recording works out the span of those from the records.
+#
+
+MAGIC = b'HALREC'
+VERSION = 1
+HEADER = struct.Struct('<6sHI')
+RECORD = struct.Struct('<dBBHffff')
+COMMAND_REF = struct.Struct('<dBBHQQ')
+SPAN = struct.Struct('<dd')
+
+# kind: values
+LIDAR = 1        # distance, velocity
+ORIENTATION = 2  # yaw, roll, pitch
+POSITION = 3     # horizontal, vertical
+IR = 4           # distance
+ULTRASONIC = 5   # distance
+SCAN = 6         # horizontal, vertical, distance, velocity
+SCAN_END = 7     # (none)
+COMMAND = 8      # see COMMAND_REF
+
+DEFAULT_CHUNK = 4096
+
+_NAN = float('nan')
+
+
+def _value(v):
+    return _NAN if v is None else v
+
+
+class Recorder:
+    '''Appends samples to a recording. Every method may be called from any
+    thread; records collect in a chunk in memory and are written out by a
+    background thread every flush_interval seconds (and synced to disk, so
+    little is lost if the robot loses power), so the cost per sample is one
+    struct pack.'''
+
+    def __init__(self, path, metadata=None, chunk=DEFAULT_CHUNK,
+                 flush_interval=1.0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._chunk = chunk
+        self._buffer = bytearray(chunk * RECORD.size)
+        self._used = 0
+        # records of the current chunk already in the file:
+        self._written = 0
+        self._low = math.inf
+        self._high = -math.inf
+        self._lock = threading.Lock()
+        self._rec = open(path + '.rec', 'wb')
+        self._idx = open(path + '.idx', 'wb')
+        self._txt = open(path + '.txt', 'wb')
+        self._rec.write(HEADER.pack(MAGIC, VERSION, chunk))
+        header = {'version': VERSION, 'started': time.time(), 'channels': {}}
+        header.update(metadata or {})
+        self._txt.write((json.dumps(header) + '\n').encode())
+        self._scans = 0
+        self.records = 0
+        self._interval = flush_interval
+        self._closing = threading.Event()
+        self._thread = None
+        if flush_interval:
+            self._thread = threading.Thread(target=self.__flush_loop,
+                                            daemon=True)
+            self._thread.start()
+        logger.info('Recording to %s', path)
+
+    def __append(self, t, kind, channel=0, aux=0, a=_NAN, b=_NAN, c=_NAN,
+                 d=_NAN):
+        with self._lock:
+            if self._rec is None:
+                return
+            RECORD.pack_into(self._buffer, self._used * RECORD.size,
+                             t, kind, channel, aux, a, b, c, d)
+            self.__extend(t)
+
+    def __extend(self, t):
+        self._used += 1
+        self.records += 1
+        if t < self._low:
+            self._low = t
+        if t > self._high:
+            self._high = t
+        if self._used == self._chunk:
+            self.__write_chunk()
+
+    def __write_pending(self):
+        # with the lock held
+        if self._written == self._used:
+            return
+        self._rec.write(memoryview(self._buffer)[
+            self._written * RECORD.size:self._used * RECORD.size])
+        self._written = self._used
+
+    def __write_chunk(self):
+        # with the lock held
+        if not self._used:
+            return
+        self.__write_pending()
+        self._idx.write(SPAN.pack(self._low, self._high))
+        self._used = 0
+        self._written = 0
+        self._low = math.inf
+        self._high = -math.inf
+
+    def __flush_loop(self):
+        while not self._closing.wait(self._interval):
+            self.flush(sync=True)
+
+    def lidar(self, t, distance, velocity):
+        self.__append(t, LIDAR, a=distance, b=velocity)
+
+    def orientation(self, t, yaw, roll, pitch):
+        self.__append(t, ORIENTATION, a=yaw, b=roll, c=pitch)
+
+    def position(self, t, horizontal, vertical):
+        self.__append(t, POSITION, a=horizontal, b=vertical)
+
+    def ir(self, t, channel, distance):
+        self.__append(t, IR, channel, a=_value(distance))
+
+    def ultrasonic(self, t, channel, distance):
+        self.__append(t, ULTRASONIC, channel, a=_value(distance))
+
+    def new_scan(self):
+        '''Id for the readings of one scan'''
+        with self._lock:
+            self._scans = (self._scans + 1) % 256
+            return self._scans
+
+    def scan(self, scan_id, reading):
+        self.__append(reading['timestamp'], SCAN, scan_id,
+                      reading.get('step', 0),
+                      reading['horizontal_position'],
+                      reading['vertical_position'],
+                      _value(reading['lidar']),
+                      _value(reading.get('velocity')))
+
+    def scan_end(self, scan_id):
+        self.__append(time.time(), SCAN_END, scan_id)
+
+    def command(self, cmd, t=None):
+        if t is None:
+            t = time.time()
+        data = (json.dumps(cmd) + '\n').encode()
+        with self._lock:
+            if self._rec is None:
+                return
+            offset = self._txt.tell()
+            self._txt.write(data)
+            COMMAND_REF.pack_into(self._buffer, self._used * RECORD.size,
+                                  t, COMMAND, 0, 0, offset, len(data))
+            self.__extend(t)
+
+    def flush(self, sync=False):
+        '''Write out the records buffered so far, and with sync make sure
+        they are on disk'''
+        with self._lock:
+            if self._rec is None:
+                return
+            self.__write_pending()
+            # commands before the records that refer to them:
+            files = (self._txt, self._rec, self._idx)
+        # the files buffer writes under their own locks; samples keep
+        # coming in while these wait on the disk:
+        for f in files:
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+
+    def close(self):
+        self._closing.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._rec is None:
+                return
+            # the last chunk may be short:
+            self.__write_chunk()
+            for f in (self._txt, self._rec, self._idx):
+                f.close()
+            self._rec = None
+        logger.info('Recorded %d records to %s', self.records, self.path)
+
+
+class Recording:
+    '''Read access to a recording. The records are memory-mapped, so
+    opening and seeking cost nothing per record.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.rec', 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.chunk = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a version %d recording: %s'
+                             % (VERSION, path))
+        self._count = (len(self._map) - HEADER.size) // RECORD.size
+        spans = array('d')
+        with open(path + '.idx', 'rb') as f:
+            data = f.read()
+        # a crash may have cut the last entry short:
+        spans.frombytes(data[:len(data) // SPAN.size * SPAN.size])
+        self._lows = spans[0::2]
+        self._highs = spans[1::2]
+        # records after the last indexed chunk, left by a recording that
+        # was not closed:
+        indexed = len(self._highs) * self.chunk
+        for start in range(indexed, self._count, self.chunk):
+            times = [self.record(i)[0]
+                     for i in range(start, min(self._count,
+                                               start + self.chunk))]
+            self._lows.append(min(times))
+            self._highs.append(max(times))
+        # a chunk's newest sample can only be older than an earlier
+        # chunk's through reordering between sensors, so seek on the
+        # running maximum, which is sorted:
+        self._reached = array('d')
+        newest = -math.inf
+        for high in self._highs:
+            newest = max(newest, high)
+            self._reached.append(newest)
+        with open(path + '.txt', 'rb') as f:
+            self._txt = f.read()
+        self.metadata = json.loads(
+            self._txt[:self._txt.index(b'\n')].decode())
+
+    def __len__(self):
+        return self._count
+
+    def channels(self, kind):
+        '''Sensor names by channel number, for 'ir' or 'ultrasonic' '''
+        return self.metadata['channels'].get(kind, [])
+
+    def start_time(self):
+        return min(self._lows) if self._lows else None
+
+    def end_time(self):
+        return max(self._highs) if self._highs else None
+
+    def record(self, i):
+        '''(timestamp, kind, channel, aux, values)'''
+        t, kind, channel, aux, a, b, c, d = RECORD.unpack_from(
+            self._map, HEADER.size + i * RECORD.size)
+        return t, kind, channel, aux, (a, b, c, d)
+
+    def command(self, i):
+        '''The command dict of COMMAND record i'''
+        t, kind, _, _, offset, length = COMMAND_REF.unpack_from(
+            self._map, HEADER.size + i * RECORD.size)
+        if kind != COMMAND:
+            raise ValueError('record %d is not a command' % i)
+        return json.loads(self._txt[offset:offset + length].decode())
+
+    def seek(self, t):
+        '''Index of the first record of the first chunk that has samples
+        at or after t'''
+        chunk = bisect.bisect_left(self._reached, t)
+        return min(self._count, chunk * self.chunk)
+
+    def records(self, start=0):
+        for i in range(start, self._count):
+            yield (i,) + self.record(i)
+
+    def close(self):
+        self._map.close()
+
+
+if __name__ == "__main__":
+    import sys
+    recording = Recording(sys.argv[1])
+    counts = {}
+    for i, t, kind, channel, aux, values in recording.records():
+        counts[kind] = counts.get(kind, 0) + 1
+    print(json.dumps({
+        'records': len(recording),
+        'start': recording.start_time(),
+        'end': recording.end_time(),
+        'by_kind': counts,
+        'metadata': recording.metadata,
+    }, indent=2))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import collections
+import logging
+import math
+import queue
+import threading
+import time
+
+from util import recorder
+from util.recorder import Recording
+
+logger = logging.getLogger(__name__)
+
+##########################################################################
+#  Replay of a recording
+##########################################################################
+#  A Player walks a recording (see util/recorder.py) in real time, or
+#  faster, and keeps the latest value of every sensor. The Replay* classes
+#  stand in for the HAL's devices on top of it, so `hal.py --network
+#  --replay <path>` serves the recorded session through the normal
+#  commands and subscriptions. Hardware commands are accepted and
+#  ignored; a scan command is answered with the next scan in the
+#  recording. Readings keep their recorded timestamps.
+#
+
+
+def _number(v):
+    return None if math.isnan(v) else v
+
+
+class Player:
+
+    def __init__(self, recording, speed=1.0, loop=False):
+        self.recording = recording
+        self.speed = speed
+        self.loop = loop
+        self.lidar = None
+        self.orientation = None
+        self.position = (0.0, 0.0)
+        self.ir = {}
+        self.ultrasonic = {}
+        self._lidar_history = collections.deque(maxlen=1024)
+        self._scan_queues = []
+        self._scan_id = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self.finished = threading.Event()
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.__play, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._running
+
+    def __play(self):
+        first = self.recording.start_time()
+        while self._running and first is not None:
+            logger.info('Replaying %s at %gx', self.recording.path,
+                        self.speed)
+            started = time.time()
+            for i, t, kind, channel, aux, values in \
+                    self.recording.records():
+                if not self._running:
+                    return
+                wait = started + (t - first) / self.speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self.__apply(i, t, kind, channel, aux, values)
+            if not self.loop:
+                break
+        logger.info('Replay finished.')
+        self.finished.set()
+        with self._lock:
+            for q in self._scan_queues:
+                q.put(None)
+
+    def __apply(self, i, t, kind, channel, aux, values):
+        a, b, c, d = values
+        if kind == recorder.LIDAR:
+            self.lidar = (t, a, b)
+            self._lidar_history.append(self.lidar)
+        elif kind == recorder.ORIENTATION:
+            self.orientation = ((a, b, c), t)
+        elif kind == recorder.POSITION:
+            self.position = (a, b)
+        elif kind == recorder.IR:
+            self.ir[channel] = _number(a)
+        elif kind == recorder.ULTRASONIC:
+            self.ultrasonic[channel] = (_number(a), t)
+        elif kind == recorder.SCAN:
+            self.position = (a, b)
+            # the first reading of a scan, when the id changes:
+            start = channel != self._scan_id
+            self._scan_id = channel
+            reading = {
+                'vertical_position': b,
+                'horizontal_position': a,
+                'lidar': _number(c),
+                'velocity': _number(d),
+                'step': aux,
+                'timestamp': t,
+            }
+            self.__publish((channel, start, reading))
+        elif kind == recorder.SCAN_END:
+            self._scan_id = None
+            self.__publish((channel, False, None))
+
+    def __publish(self, item):
+        with self._lock:
+            for q in self._scan_queues:
+                q.put(item)
+
+    def lidar_since(self, t):
+        return [s for s in list(self._lidar_history) if s[0] > t]
+
+    def next_scan(self, callback=None):
+        '''Wait for the next scan to start playing and pass each of its
+        readings to callback as they play. Returns the readings, or an
+        empty list if the recording ends first.'''
+        q = queue.Queue()
+        with self._lock:
+            if self.finished.is_set():
+                return []
+            self._scan_queues.append(q)
+        readings = []
+        scan_id = None
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                channel, start, reading = item
+                if scan_id is None:
+                    if not start:
+                        continue  # joined in the middle of a scan
+                    scan_id = channel
+                if channel != scan_id or reading is None:
+                    break
+                readings.append(reading)
+                if callback is not None:
+                    callback(reading)
+        finally:
+            with self._lock:
+                self._scan_queues.remove(q)
+        return readings
+
+
+class ReplayRoofMount:
+
+    def __init__(self, player):
+        self._player = player
+        self._point_cloud = None
+
+    def lidar_since(self, t):
+        return self._player.lidar_since(t)
+
+    def lidar_reading(self):
+        sample = self._player.lidar
+        if sample is None:
+            return {'lidar': None, 'velocity': None, 'timestamp': None}
+        t, distance, velocity = sample
+        return {'lidar': distance, 'velocity': velocity, 'timestamp': t}
+
+    def horizontal_position(self):
+        return self._player.position[0]
+
+    def vertical_position(self):
+        return self._player.position[1]
+
+    def position(self):
+        return {
+            'vertical_position': self.vertical_position(),
+            'horizontal_position': self.horizontal_position(),
+        }
+
+    def get_readings(self):
+        r = self.position()
+        r['lidar'] = self.lidar_reading()['lidar']
+        return r
+
+    def set_horizontal_position(self, degrees):
+        logger.debug('Replay: ignoring horizontal position %s', degrees)
+
+    def set_vertical_position(self, degrees, wait=True):
+        # no servo move to wait for, as for an out of range position:
+        logger.debug('Replay: ignoring vertical position %s', degrees)
+        return None
+
+    def point(self, horizontal, vertical):
+        logger.debug('Replay: ignoring point %s, %s', horizontal, vertical)
+
+    def horizontal_scan(self, vertical_degrees, resolution=1.0,
+                        callback=None):
+        return self._player.next_scan(callback)
+
+    def continuous_scan(self, vertical_degrees, rate=None, callback=None):
+        return self._player.next_scan(callback)
+
+    def volume_scan(self, low, high, increment, resolution=1.0,
+                    callback=None):
+        return self._player.next_scan(callback)
+
+    def point_cloud(self, readings):
+        if self._point_cloud is None:
+            from lib.pointcloud import PointCloud
+            metadata = self._player.recording.metadata
+            self._point_cloud = PointCloud(
+                metadata.get('stepsPerRevolution', 3200),
+                metadata.get('offset', (0.0, 0.0, 0.0)))
+        return self._point_cloud.points(readings)
+
+
+class ReplayOrientation:
+
+    def __init__(self, player):
+        self._player = player
+
+    def running(self):
+        return True
+
+    def latest(self):
+        if self._player.orientation is None:
+            return {}
+        return {'euler': self._player.orientation}
+
+    def euler(self):
+        if self._player.orientation is None:
+            return (0.0, 0.0, 0.0)
+        return self._player.orientation[0]
+
+
+class ReplayIR:
+
+    def __init__(self, player, channel):
+        self._player = player
+        self._channel = channel
+
+    def distance(self):
+        return self._player.ir.get(self._channel)
+
+
+class ReplayUltraSonicArray:
+
+    def __init__(self, player, names):
+        self._player = player
+        self._channels = {name: i for i, name in enumerate(names)}
+        self._sensors = names
+
+    def latest(self, name):
+        return self._player.ultrasonic.get(self._channels[name])
+
+
+def devices(path, speed=1.0, loop=False):
+    '''Start playing the recording at path. Returns the player and a dict
+    of the stand-in devices the recording has data for.'''
+    recording = Recording(path)
+    player = Player(recording, speed, loop)
+    kinds = set(recording.metadata.get('devices', []))
+    found = {}
+    if 'roofmount' in kinds:
+        found['roofmount'] = ReplayRoofMount(player)
+    if 'orientation' in kinds:
+        found['orientation'] = ReplayOrientation(player)
+    ir = recording.channels('ir')
+    if ir:
+        found['ir'] = {name: ReplayIR(player, channel)
+                       for channel, name in enumerate(ir)}
+    ultrasonic = recording.channels('ultrasonic')
+    if ultrasonic:
+        found['ultrasonic'] = ReplayUltraSonicArray(player, ultrasonic)
+    player.start()
+    return player, found
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Sampler:
+    '''Polls the HAL's sensors on a background thread and passes every new
+    sample to each sink. Lidar samples are drained from the lidar's ring
+    buffer, so none are missed while it samples continuously; the other
+    sensors are passed on when their value or timestamp changes.
+
+    A sink has lidar(t, distance, velocity), orientation(t, yaw, roll,
+    pitch), position(t, horizontal, vertical), ir(t, channel, distance) and
+    ultrasonic(t, channel, distance). Channels number the sensors in name
+    order.'''
+
+    def __init__(self, sinks, rate, roofmount=None, orientation=None,
+                 ir=None, ultrasonic=None):
+        self._sinks = list(sinks)
+        self._period = 1.0 / rate
+        self._roofmount = roofmount
+        self._orientation = orientation
+        self._ir = sorted((ir or {}).items())
+        self._ultrasonic = ultrasonic
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.__sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __sample(self):
+        sinks = self._sinks
+        last_lidar = time.time()
+        last = {}
+        while self._running:
+            now = time.time()
+            try:
+                if self._roofmount is not None:
+                    for t, distance, velocity in \
+                            self._roofmount.lidar_since(last_lidar):
+                        for sink in sinks:
+                            sink.lidar(t, distance, velocity)
+                        last_lidar = t
+                    position = (self._roofmount.horizontal_position(),
+                                self._roofmount.vertical_position())
+                    if last.get('position') != position:
+                        last['position'] = position
+                        for sink in sinks:
+                            sink.position(now, *position)
+                if self._orientation is not None \
+                        and self._orientation.running():
+                    euler = self._orientation.latest().get('euler')
+                    if euler is not None and last.get('euler') != euler:
+                        last['euler'] = euler
+                        (yaw, roll, pitch), t = euler
+                        for sink in sinks:
+                            sink.orientation(t, yaw, roll, pitch)
+                for channel, (name, ir) in enumerate(self._ir):
+                    distance = ir.distance()
+                    if last.get(('ir', name)) != distance:
+                        last[('ir', name)] = distance
+                        for sink in sinks:
+                            sink.ir(now, channel, distance)
+                if self._ultrasonic is not None:
+                    for channel, name in enumerate(
+                            sorted(self._ultrasonic._sensors)):
+                        latest = self._ultrasonic.latest(name)
+                        if latest is not None \
+                                and last.get(('us', name)) != latest:
+                            last[('us', name)] = latest
+                            for sink in sinks:
+                                sink.ultrasonic(latest[1], channel,
+                                                latest[0])
+            except OSError as e:
+                logger.warning('Sampling failed: %s', e)
+            wait = now + self._period - time.time()
+            if wait > 0:
+                time.sleep(wait)
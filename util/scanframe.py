@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import struct
+
+##########################################################################
+#  Binary scan frames
+##########################################################################
+#  Sent in place of one JSON line per reading when a scan is requested
+#  with "encoding": "binary". Each frame is a header followed by `count`
+#  fixed width records, all little endian:
+#
+#    header: magic "SCAN", version u8, flags u8, count u16,
+#            vertical_position f32                            (12 bytes)
+#    record: step u32, horizontal_position f32, lidar u16 (cm),
+#            velocity i16 (cm/s), timestamp f64                 (20 bytes)
+#
+#  JSON lines always start with '{', so a client can tell the two apart
+#  by the first byte. Records can be read straight into NumPy with:
+#
+#    numpy.frombuffer(buf, dtype=numpy.dtype(RECORD_DTYPE),
+#                     count=count, offset=HEADER.size)
+#
+#  With "encoding": "points" the readings are converted to Cartesian
+#  points on the robot first (see lib/pointcloud.py) and sent with the
+#  same header, magic "PNTS", and records of:
+#
+#    x f32, y f32, z f32 (cm), lidar u16 (cm), timestamp f64   (22 bytes)
+#
+MAGIC = b'SCAN'
+POINTS_MAGIC = b'PNTS'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBBHf')
+RECORD = struct.Struct('<IfHhd')
+
+RECORD_DTYPE = [
+    ('step', '<u4'),
+    ('horizontal_position', '<f4'),
+    ('lidar', '<u2'),
+    ('velocity', '<i2'),
+    ('timestamp', '<f8'),
+]
+
+POINT = struct.Struct('<fffHd')
+
+POINT_DTYPE = [
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('lidar', '<u2'),
+    ('timestamp', '<f8'),
+]
+
+# keep a frame inside a handful of TCP segments:
+DEFAULT_BATCH = 64
+MAX_BATCH = 0xFFFF
+
+
+def _clamp(v, lo, hi):
+    return max(lo, min(hi, int(v)))
+
+
+class ScanFrameWriter:
+    '''Collects scan readings and hands complete binary frames to write().
+    Call flush() once the scan is done to send the remainder.'''
+
+    def __init__(self, write, vertical_position, batch=DEFAULT_BATCH):
+        self._write = write
+        self._vertical = float(vertical_position)
+        self._batch = _clamp(batch, 1, MAX_BATCH)
+        self._buffer = bytearray(HEADER.size + RECORD.size * self._batch)
+        self._count = 0
+
+    def add(self, reading):
+        if reading['vertical_position'] != self._vertical:
+            # the header carries the elevation, so start a new frame:
+            self.flush()
+            self._vertical = float(reading['vertical_position'])
+        RECORD.pack_into(
+            self._buffer, HEADER.size + RECORD.size * self._count,
+            reading['step'],
+            reading['horizontal_position'],
+            _clamp(reading['lidar'], 0, 0xFFFF),
+            _clamp(reading['velocity'], -0x8000, 0x7FFF),
+            reading['timestamp'])
+        self._count += 1
+        if self._count == self._batch:
+            self.flush()
+
+    def flush(self):
+        if not self._count:
+            return
+        HEADER.pack_into(self._buffer, 0, MAGIC, VERSION, 0,
+                         self._count, self._vertical)
+        self._write(bytes(self._buffer[:HEADER.size +
+                                       RECORD.size * self._count]))
+        self._count = 0
+
+
+class PointFrameWriter:
+    '''Collects scan readings and converts each full batch to points with
+    to_points(readings), which returns a POINT_DTYPE structured array.'''
+
+    def __init__(self, write, vertical_position, to_points,
+                 batch=DEFAULT_BATCH):
+        self._write = write
+        self._vertical = float(vertical_position)
+        self._to_points = to_points
+        self._batch = _clamp(batch, 1, MAX_BATCH)
+        self._readings = []
+
+    def add(self, reading):
+        if reading['vertical_position'] != self._vertical:
+            self.flush()
+            self._vertical = float(reading['vertical_position'])
+        self._readings.append(reading)
+        if len(self._readings) == self._batch:
+            self.flush()
+
+    def flush(self):
+        if not self._readings:
+            return
+        points = self._to_points(self._readings)
+        self._write(HEADER.pack(POINTS_MAGIC, VERSION, 0, len(points),
+                                self._vertical) + points.tobytes())
+        self._readings = []
+
+
+def read_frame(buf, offset=0):
+    '''Client side helper. Returns (vertical_position, records, next_offset)
+    or None if buf does not yet hold a whole frame. records is a NumPy
+    structured array when NumPy is installed, otherwise a list of tuples.'''
+    if len(buf) - offset < HEADER.size:
+        return None
+    magic, version, flags, count, vertical = HEADER.unpack_from(buf, offset)
+    if magic == MAGIC and version == VERSION:
+        record, dtype = RECORD, RECORD_DTYPE
+    elif magic == POINTS_MAGIC and version == VERSION:
+        record, dtype = POINT, POINT_DTYPE
+    else:
+        raise ValueError('Not a version %d scan frame' % VERSION)
+    end = offset + HEADER.size + record.size * count
+    if len(buf) < end:
+        return None
+    try:
+        import numpy
+        records = numpy.frombuffer(buf, dtype=numpy.dtype(dtype),
+                                   count=count, offset=offset + HEADER.size)
+    except ImportError:
+        records = [record.unpack_from(buf, offset + HEADER.size +
+                                      record.size * i)
+                   for i in range(count)]
+    return vertical, records, end
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+logger = logging.getLogger(__name__)
+
+##########################################################################
+#  Shared memory telemetry
+##########################################################################
+#  For consumers on the Pi itself: the HAL publishes samples into rings of
+#  fixed layout records in POSIX shared memory, and readers in other
+#  processes unpack them straight out of the mapping, with no socket, no
+#  JSON and no system call per sample.
+#
+#  Each ring has one writer. Layout (little endian):
+#
+#    magic     8s   b'HALSHM\0\0'
+#    version   H    2
+#    slot      H    bytes per slot
+#    format    16s  struct format of a record, NUL padded
+#    capacity  I    slots
+#    owner     I    pid of the writer
+#    (padding  4x)
+#    count     Q    records written so far
+#
+#  then `capacity` slots of a sequence number (Q) followed by the record.
+#  Record n goes in slot n % capacity. Its writer sets the sequence to
+#  2n + 1 while it writes and to 2n + 2 when done, then bumps count; a
+#  reader that sees 2n + 2 both before and after copying record n knows
+#  it got it whole (a seqlock per slot).
+#
+#  A writer only replaces a ring of the same name when its owner has
+#  exited, so a second HAL cannot pull the rings from under the first.
+#
+
+MAGIC = b'HALSHM\0\0'
+VERSION = 2
+HEADER = struct.Struct('<8sHH16sII4xQ')
+COUNT = struct.Struct('<Q')
+COUNT_OFFSET = HEADER.size - COUNT.size
+SEQUENCE = struct.Struct('<Q')
+
+# record layouts of the HAL's rings:
+LIDAR = '<dff'            # timestamp, distance, velocity
+ORIENTATION = '<dfff'     # timestamp, yaw, roll, pitch
+POSITION = '<dff'         # timestamp, horizontal, vertical
+SCAN = '<dffffHH'         # timestamp, horizontal, vertical, distance,
+#                           velocity, step, scan id
+
+DEFAULT_CAPACITY = 4096
+
+_NAN = float('nan')
+
+
+def _value(v):
+    return _NAN if v is None else v
+
+
+def _owner(shm):
+    '''pid of the writer of a ring, or None if it is not one of ours'''
+    if shm.size < HEADER.size:
+        return None
+    header = HEADER.unpack_from(shm.buf, 0)
+    if header[0] != MAGIC or header[1] != VERSION:
+        return None
+    return header[5]
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return False  # left by an earlier run that had the same pid
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # someone else's
+    return True
+
+
+def _slot_size(record):
+    size = SEQUENCE.size + record.size
+    return (size + 7) // 8 * 8
+
+
+class RingWriter:
+
+    def __init__(self, name, fmt, capacity=DEFAULT_CAPACITY):
+        self.name = name
+        self._record = struct.Struct(fmt)
+        self._slot = _slot_size(self._record)
+        self._capacity = capacity
+        size = HEADER.size + capacity * self._slot
+        try:
+            existing = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            pass
+        else:
+            owner = _owner(existing)
+            if owner is not None and _alive(owner):
+                # attaching registered it to be unlinked at our exit:
+                resource_tracker.unregister(existing._name, 'shared_memory')
+                existing.close()
+                raise FileExistsError(
+                    'shared memory %s is in use by process %d; give this '
+                    'instance another prefix' % (name, owner))
+            # left behind by a run that did not shut down cleanly:
+            existing.close()
+            existing.unlink()
+        self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self._buf = self._shm.buf
+        HEADER.pack_into(self._buf, 0, MAGIC, VERSION, self._slot,
+                         fmt.encode(), capacity, os.getpid(), 0)
+        self._count = 0
+
+    def write(self, *values):
+        buf = self._buf
+        if buf is None:
+            return  # closed
+        n = self._count
+        offset = HEADER.size + (n % self._capacity) * self._slot
+        SEQUENCE.pack_into(buf, offset, 2 * n + 1)
+        self._record.pack_into(buf, offset + SEQUENCE.size, *values)
+        SEQUENCE.pack_into(buf, offset, 2 * n + 2)
+        self._count = n + 1
+        COUNT.pack_into(buf, COUNT_OFFSET, n + 1)
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class RingReader:
+    '''Reads a ring published by another process. Records come back as
+    tuples in the ring's struct format.'''
+
+    def __init__(self, name, forked=False):
+        '''forked: the writer is a child forked from this process, so the
+        two share a resource tracker and the writer's registration
+        stands.'''
+        self.name = name
+        self._shm = shared_memory.SharedMemory(name)
+        if not forked:
+            # only the creator may unlink it, not this process's exit:
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._buf = self._shm.buf
+        magic, version, self._slot, fmt, self.capacity, self.owner, \
+            count = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a version %d ring: %s' % (VERSION, name))
+        self.format = fmt.rstrip(b'\0').decode()
+        self._record = struct.Struct(self.format)
+
+    def count(self):
+        '''Number of records written so far'''
+        return COUNT.unpack_from(self._buf, COUNT_OFFSET)[0]
+
+    def read(self, n):
+        '''Record n, or None if it is not (or no longer) in the ring, or
+        was being rewritten while it was read.'''
+        offset = HEADER.size + (n % self.capacity) * self._slot
+        buf = self._buf
+        done = 2 * n + 2
+        if SEQUENCE.unpack_from(buf, offset)[0] != done:
+            return None
+        record = self._record.unpack_from(buf, offset + SEQUENCE.size)
+        if SEQUENCE.unpack_from(buf, offset)[0] != done:
+            return None
+        return record
+
+    def latest(self):
+        '''The newest record, or None if nothing has been written'''
+        while True:
+            count = self.count()
+            if count == 0:
+                return None
+            record = self.read(count - 1)
+            if record is not None:
+                return record
+
+    def since(self, n):
+        '''Records n onwards that are still in the ring, and the number to
+        pass next time. Records the writer lapped are skipped.'''
+        count = self.count()
+        records = []
+        for i in range(max(n, count - self.capacity), count):
+            record = self.read(i)
+            if record is not None:
+                records.append(record)
+        return records, count
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+
+
+class SharedTelemetry:
+    '''Sampler and scan sink publishing the HAL's lidar, orientation, roof
+    mount position and scan readings as rings named <prefix>_lidar,
+    <prefix>_orientation, <prefix>_position and <prefix>_scan.'''
+
+    def __init__(self, prefix='hal', capacity=DEFAULT_CAPACITY):
+        rings = []
+        try:
+            for key, fmt in (('lidar', LIDAR), ('orientation', ORIENTATION),
+                             ('position', POSITION), ('scan', SCAN)):
+                rings.append(RingWriter(prefix + '_' + key, fmt, capacity))
+        except Exception:
+            for ring in rings:
+                ring.close()
+            raise
+        self._lidar, self._orientation, self._position, self._scan = rings
+        self._scans = 0
+        logger.info('Publishing telemetry to shared memory as %s_*',
+                    prefix)
+
+    def lidar(self, t, distance, velocity):
+        self._lidar.write(t, distance, velocity)
+
+    def orientation(self, t, yaw, roll, pitch):
+        self._orientation.write(t, yaw, roll, pitch)
+
+    def position(self, t, horizontal, vertical):
+        self._position.write(t, horizontal, vertical)
+
+    def ir(self, t, channel, distance):
+        pass
+
+    def ultrasonic(self, t, channel, distance):
+        pass
+
+    def new_scan(self):
+        self._scans = (self._scans + 1) % 65536
+        return self._scans
+
+    def scan(self, scan_id, reading):
+        self._scan.write(reading['timestamp'],
+                         reading['horizontal_position'],
+                         reading['vertical_position'],
+                         _value(reading['lidar']),
+                         _value(reading.get('velocity')),
+                         reading.get('step', 0), scan_id)
+
+    def scan_end(self, scan_id):
+        pass
+
+    def close(self):
+        for ring in (self._lidar, self._orientation, self._position,
+                     self._scan):
+            ring.close()
+
+
+if __name__ == "__main__":
+    # follow the lidar ring of a running HAL:
+    import sys
+    import time
+    prefix = sys.argv[1] if len(sys.argv) > 1 else 'hal'
+    reader = RingReader(prefix + '_lidar')
+    n = reader.count()
+    while True:
+        time.sleep(1)
+        records, n = reader.since(n)
+        print(len(records), 'samples/s, latest:', reader.latest())
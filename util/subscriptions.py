@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+import time
+
+from util.metrics import registry
+
+
+def _changed(old, new, threshold):
+    '''True if any number in new differs from old by at least threshold,
+    or anything else about them differs.'''
+    if isinstance(new, dict) and isinstance(old, dict):
+        if new.keys() != old.keys():
+            return True
+        return any(_changed(old[k], new[k], threshold) for k in new
+                   if k != 'timestamp')
+    if isinstance(new, (list, tuple)) and isinstance(old, (list, tuple)):
+        if len(new) != len(old):
+            return True
+        return any(_changed(o, n, threshold) for o, n in zip(old, new))
+    if isinstance(new, (int, float)) and isinstance(old, (int, float)) \
+            and not isinstance(new, bool):
+        return abs(new - old) >= threshold
+    return new != old
+
+
+class Subscription:
+
+    def __init__(self, topic, rate, threshold=None):
+        self.topic = topic
+        self.period = 1.0 / rate
+        self.threshold = threshold
+        self.due = time.time()
+        self.last = None
+
+
+class Subscriptions:
+    '''Pushes telemetry to subscribed connections from one background
+    thread. topics maps a topic name to a function returning its current
+    value; it is called at most once per tick however many subscribers
+    want it. All topics due for a connection in the same tick go out
+    together in one message:
+
+        {"telemetry": {"<topic>": <value>, ...}, "timestamp": <seconds>}
+
+    The thread never waits on a client that is not keeping up: its frames
+    are skipped until it catches up, and it then gets the latest values.'''
+
+    # never sleep longer than this, so new subscriptions start promptly:
+    _max_wait = 0.1
+
+    def __init__(self, topics):
+        self._topics = topics
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+        self._skipped = registry.counter('telemetry.skipped')
+
+    def topics(self):
+        return sorted(self._topics)
+
+    def count(self):
+        '''Number of subscriptions across all connections'''
+        with self._lock:
+            return sum(len(subs) for subs in self._subscribers.values())
+
+    def subscribe(self, conn, topic, rate, threshold=None):
+        if topic not in self._topics:
+            raise ValueError('unknown topic: ' + str(topic))
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        with self._lock:
+            self._subscribers.setdefault(conn, {})[topic] = \
+                Subscription(topic, rate, threshold)
+        self.start()
+        self._wake.set()
+
+    def unsubscribe(self, conn, topic=None):
+        '''Drop one topic, or every topic when topic is None'''
+        with self._lock:
+            subs = self._subscribers.get(conn, {})
+            if topic is None:
+                subs.clear()
+            else:
+                subs.pop(topic, None)
+            if not subs:
+                self._subscribers.pop(conn, None)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.__push, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __push(self):
+        while self._running:
+            now = time.time()
+            values = {}
+            with self._lock:
+                for conn in [c for c in self._subscribers
+                             if not getattr(c, 'connected', True)]:
+                    del self._subscribers[conn]
+                subscribers = [(conn, list(subs.values()))
+                               for conn, subs in self._subscribers.items()]
+            wait = self._max_wait
+            for conn, subs in subscribers:
+                frame = {}
+                sent = []
+                for sub in subs:
+                    if sub.due <= now:
+                        value = self.__sample(values, sub.topic)
+                        if sub.threshold is None or sub.last is None or \
+                                _changed(sub.last, value, sub.threshold):
+                            frame[sub.topic] = value
+                            sent.append((sub, value))
+                        sub.due += sub.period
+                        if sub.due <= now:
+                            # fell behind; do not send a burst:
+                            sub.due = now + sub.period
+                    wait = min(wait, sub.due - now)
+                if frame:
+                    if conn.send(json.dumps({'telemetry': frame,
+                                             'timestamp': now}),
+                                 block=False):
+                        # thresholds compare against what the client has:
+                        for sub, value in sent:
+                            sub.last = value
+                    else:
+                        self._skipped.add()
+            self._wake.wait(max(0, wait))
+            self._wake.clear()
+
+    def __sample(self, values, topic):
+        if topic not in values:
+            try:
+                values[topic] = self._topics[topic]()
+            except Exception as e:
+                values[topic] = {'error': str(e)}
+        return values[topic]
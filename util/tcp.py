@@ -1,63 +1,174 @@
 #!/usr/bin/env python3
 
+import asyncio
 import logging
-import socket
+import queue
+import threading
+
+from util.metrics import registry
 
 logger = logging.getLogger(__name__)
 
 
+class Connection(asyncio.Protocol):
+    '''One client connection. Incoming newline framed commands are handed
+    to the handler on a worker thread dedicated to this connection, so a
+    slow command only holds up the client that sent it. send() may be
+    called from any thread.'''
+
+    # stop writing from worker threads when this much is queued in the
+    # transport, until the event loop has drained it:
+    high_water = 256 * 1024
+    # seconds a sender waits for a client to read before giving up on it;
+    # scans stream from the thread every hardware command runs on:
+    send_timeout = 10
+
+    def __init__(self, server):
+        self._server = server
+        self._loop = server.loop
+        self._transport = None
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._queue = queue.Queue()
+        self._writable = threading.Event()
+        self._writable.set()
+        self._worker = None
+        self.address = None
+        self.connected = False
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.messages_received = 0
+
+    # event loop side:
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._transport.set_write_buffer_limits(high=self.high_water)
+        self.address = transport.get_extra_info('peername')
+        self.connected = True
+        logger.info('Connection address: %s', self.address[0])
+        self._worker = threading.Thread(target=self.__work, daemon=True)
+        self._worker.start()
+        self._server.connections.add(self)
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        # only look at bytes that have not been searched yet:
+        while True:
+            i = self._buffer.find(b'\n', self._scanned)
+            if i < 0:
+                self._scanned = len(self._buffer)
+                return
+            line = bytes(self._buffer[:i])
+            del self._buffer[:i + 1]
+            self._scanned = 0
+            if line:
+                self.messages_received += 1
+                # bad bytes make bad JSON, which is logged and dropped:
+                self._queue.put(str(line, 'utf-8', 'replace'))
+
+    def connection_lost(self, exc):
+        self.connected = False
+        self._writable.set()
+        self._server.connections.discard(self)
+        self._queue.put(None)
+        logger.info('Connection closed: %s', self.address[0])
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    # worker side:
+
+    def __work(self):
+        while True:
+            payload = self._queue.get()
+            if payload is None:
+                return
+            try:
+                self._server.handler(payload, self)
+            except Exception:
+                logger.exception('Handler failed on %s', payload)
+
+    def send(self, msg, block=True):
+        return self.send_bytes((msg + '\n').encode(), block)
+
+    def send_bytes(self, data, block=True):
+        '''Queue data for the client. Without block, data is dropped
+        rather than waiting for the client to catch up; returns whether
+        it was queued.'''
+        if not self.connected:
+            logger.warning('Not connected. Can not send.')
+            return False
+        if threading.current_thread() is not self._server.thread:
+            if not block and not self._writable.is_set():
+                return False
+            # block the sender rather than buffering without bound, but
+            # not for a client that has stopped reading:
+            if not self._writable.wait(self.send_timeout):
+                logger.warning('%s stopped reading; closing',
+                               self.address[0])
+                self.close()
+                return False
+        self.messages_sent += 1
+        self.bytes_sent += len(data)
+        self._loop.call_soon_threadsafe(self.__write, data)
+        return True
+
+    def __write(self, data):
+        if self.connected:
+            self._transport.write(data)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._transport.close)
+
+
 class TCP:
     bind_ip = '0.0.0.0'
     bind_port = 9091
-    conn_buffer_size = 4096
 
     def __init__(self):
-        logger.setLevel(logging.DEBUG)
-        self.conn = None
+        self.loop = None
+        self.thread = None
+        self.handler = None
+        self.connections = set()
 
     def send(self, msg):
-        if self.conn:
-            print("Sending " + msg)
-            self.conn.sendall((msg + '\n').encode())
-        else:
-            print("Not connected. Can not send.")
+        '''Send to every connected client.'''
+        if not self.connections:
+            logger.warning('Not connected. Can not send.')
+        for conn in list(self.connections):
+            conn.send(msg)
+
+    def stats(self):
+        return [{
+            'address': '%s:%d' % conn.address[:2],
+            'messages_received': conn.messages_received,
+            'messages_sent': conn.messages_sent,
+            'bytes_sent': conn.bytes_sent,
+        } for conn in list(self.connections)]
 
     def listen(self, handler):
-        print(
-            "Listening for TCP/IP connections on port ", self.bind_port)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((self.bind_ip, self.bind_port))
-        s.listen(1)
-        exit = False
-        while True:
-            try:
-                self.conn, addr = s.accept()
-                print('Connection address: ' + addr[0])
-                smsg = ""
-                while True:
-                    buffer = self.conn.recv(self.conn_buffer_size)
-                    smsg += str(buffer, "utf-8")
-                    # print("Received " + str(buffer, "utf-8"))
-                    if not buffer:
-                        break
-                    cmds = smsg.split('\n')
-                    if smsg.endswith('\n'):
-                        smsg = ''
-                    else:
-                        smsg = cmds[-1]
-                        cmds = cmds[:-1]
-                    for cmd in cmds:
-                        if cmd:
-                            handler(cmd)
-            except KeyboardInterrupt:
-                print("User exit.")
-                exit = True
-                break
-            if exit:
-                break
-        if self.conn:
-            self.conn.close()
-            self.conn = None
-            s.close()
-            print("Connection closed.")
+        '''Serve clients until interrupted. handler(payload, conn) is called
+        for each command with the connection that sent it.'''
+        logger.info('Listening for TCP/IP connections on port %d',
+                    self.bind_port)
+        self.handler = handler
+        registry.gauge('connections', self.stats)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.current_thread()
+        server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: Connection(self), self.bind_ip, self.bind_port,
+            reuse_address=True))
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            logger.info('User exit.')
+        server.close()
+        for conn in list(self.connections):
+            conn._transport.close()
+        self.loop.run_until_complete(server.wait_closed())
+        self.loop.close()
+        logger.info('Connection closed.')
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import logging
+import math
+import socket
+import struct
+import threading
+import time
+
+from util import recorder
+from util.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+##########################################################################
+#  UDP telemetry
+##########################################################################
+#  High rate samples go out as datagrams instead of over TCP, so a lost
+#  packet costs the samples in it rather than stalling every sample behind
+#  it until it is retransmitted. Samples are packed into as few datagrams
+#  as fit the MTU, and a datagram is sent at the latest `maxDelayMs` after
+#  its first sample. Commands stay on TCP.
+#
+#  Datagram (little endian):
+#
+#    magic     4s  b'HALU'
+#    version   B   1
+#    flags     B   0
+#    count     H   number of records
+#    sequence  I   per destination, +1 per datagram; a jump is a loss
+#    sent      d   time the datagram was sent
+#
+#  followed by `count` records in the recording layout (see
+#  util/recorder.py): timestamp, kind, channel, aux and four values.
+#
+
+MAGIC = b'HALU'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHId')
+RECORD = recorder.RECORD
+# IPv4 and UDP headers:
+OVERHEAD = 28
+
+_NAN = float('nan')
+
+
+def _value(v):
+    return _NAN if v is None else v
+
+
+class Destination:
+
+    def __init__(self, address, conn=None):
+        self.address = address
+        # the TCP connection that asked for it, if any:
+        self.conn = conn
+        self.sequence = 0
+
+
+class UdpTelemetry:
+    '''Sampler and scan sink sending samples to UDP destinations: fixed
+    ones from the config, a multicast group, and clients that ask for it
+    over TCP (dropped when their connection closes).'''
+
+    def __init__(self, config):
+        mtu = config.get('mtu', 1500)
+        self._capacity = (mtu - OVERHEAD - HEADER.size) // RECORD.size
+        self._delay = config.get('maxDelayMs', 10) / 1000.0
+        self._buffer = bytearray(
+            HEADER.size + self._capacity * RECORD.size)
+        self._used = 0
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._destinations = []
+        for text in config.get('destinations', []):
+            host, port = text.rsplit(':', 1)
+            self._destinations.append(Destination((host, int(port))))
+        multicast = config.get('multicast')
+        if multicast and multicast.get('group'):
+            self._socket.setsockopt(socket.IPPROTO_IP,
+                                    socket.IP_MULTICAST_TTL,
+                                    multicast.get('ttl', 1))
+            self._destinations.append(Destination(
+                (multicast['group'], multicast.get('port', 9092))))
+        self._sent = registry.counter('udp.datagrams')
+        self._dropped = registry.counter('udp.dropped')
+        self._scans = 0
+        self._running = True
+        self._thread = threading.Thread(target=self.__flush_loop,
+                                        daemon=True)
+        self._thread.start()
+
+    def add(self, conn, port):
+        '''Send to the host of a TCP connection, on port'''
+        address = (conn.address[0], port)
+        with self._lock:
+            self._destinations = [d for d in self._destinations
+                                  if d.address != address] + \
+                [Destination(address, conn)]
+
+    def remove(self, conn):
+        with self._lock:
+            self._destinations = [d for d in self._destinations
+                                  if d.conn is not conn]
+
+    def __append(self, t, kind, channel=0, aux=0, a=_NAN, b=_NAN, c=_NAN,
+                 d=_NAN):
+        with self._lock:
+            RECORD.pack_into(self._buffer,
+                             HEADER.size + self._used * RECORD.size,
+                             t, kind, channel, aux, a, b, c, d)
+            self._used += 1
+            if self._used == self._capacity:
+                self.__send()
+
+    def __send(self):
+        # with the lock held
+        if not self._used:
+            return
+        destinations = [d for d in self._destinations
+                        if d.conn is None or d.conn.connected]
+        failed = []
+        data = memoryview(self._buffer)[
+            :HEADER.size + self._used * RECORD.size]
+        now = time.time()
+        try:
+            for destination in destinations:
+                HEADER.pack_into(self._buffer, 0, MAGIC, VERSION, 0,
+                                 self._used, destination.sequence, now)
+                destination.sequence = \
+                    (destination.sequence + 1) & 0xffffffff
+                try:
+                    self._socket.sendto(data, destination.address)
+                    self._sent.add()
+                except socket.gaierror as e:
+                    failed.append((destination, e))
+                except OSError:
+                    # a full socket buffer or an unreachable host; the
+                    # receiver sees the gap in the sequence:
+                    self._dropped.add()
+                except Exception as e:
+                    # an address that can never work:
+                    failed.append((destination, e))
+        finally:
+            self._used = 0
+            for destination, e in failed:
+                logger.warning('Dropping UDP destination %s: %s',
+                               destination.address, e)
+                destinations.remove(destination)
+            self._destinations = destinations
+
+    def __flush_loop(self):
+        while self._running:
+            time.sleep(self._delay)
+            with self._lock:
+                self.__send()
+
+    def lidar(self, t, distance, velocity):
+        self.__append(t, recorder.LIDAR, a=distance, b=velocity)
+
+    def orientation(self, t, yaw, roll, pitch):
+        self.__append(t, recorder.ORIENTATION, a=yaw, b=roll, c=pitch)
+
+    def position(self, t, horizontal, vertical):
+        self.__append(t, recorder.POSITION, a=horizontal, b=vertical)
+
+    def ir(self, t, channel, distance):
+        self.__append(t, recorder.IR, channel, a=_value(distance))
+
+    def ultrasonic(self, t, channel, distance):
+        self.__append(t, recorder.ULTRASONIC, channel, a=_value(distance))
+
+    def new_scan(self):
+        with self._lock:
+            self._scans = (self._scans + 1) % 256
+            return self._scans
+
+    def scan(self, scan_id, reading):
+        self.__append(reading['timestamp'], recorder.SCAN, scan_id,
+                      reading.get('step', 0),
+                      reading['horizontal_position'],
+                      reading['vertical_position'],
+                      _value(reading['lidar']),
+                      _value(reading.get('velocity')))
+
+    def scan_end(self, scan_id):
+        self.__append(time.time(), recorder.SCAN_END, scan_id)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        with self._lock:
+            self.__send()
+        self._socket.close()
+
+
+def decode(datagram):
+    '''(sequence, sent, records) of a datagram, with records as
+    (timestamp, kind, channel, aux, values) tuples'''
+    magic, version, flags, count, sequence, sent = \
+        HEADER.unpack_from(datagram, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version %d telemetry datagram' % VERSION)
+    records = []
+    for i in range(count):
+        t, kind, channel, aux, a, b, c, d = RECORD.unpack_from(
+            datagram, HEADER.size + i * RECORD.size)
+        records.append((t, kind, channel, aux, (a, b, c, d)))
+    return sequence, sent, records
+
+
+if __name__ == "__main__":
+    # receive telemetry and report rates, losses and latency:
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9092)
+    parser.add_argument('--group', help='multicast group to join')
+    parser.add_argument('--hal', help='host:port of a HAL to ask for '
+                        'telemetry over TCP')
+    args = parser.parse_args()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', args.port))
+    if args.group:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        struct.pack('4s4s', socket.inet_aton(args.group),
+                                    socket.inet_aton('0.0.0.0')))
+    if args.hal:
+        import json
+        host, port = args.hal.rsplit(':', 1)
+        control = socket.create_connection((host, int(port)))
+        control.sendall((json.dumps({'command': 'udp_telemetry',
+                                     'port': args.port}) + '\n').encode())
+    expected = None
+    datagrams = records = lost = 0
+    delays = []
+    report = time.time() + 1
+    while True:
+        data, sender = sock.recvfrom(65536)
+        sequence, sent, batch = decode(data)
+        if expected is not None and sequence != expected:
+            lost += (sequence - expected) & 0xffffffff
+        expected = (sequence + 1) & 0xffffffff
+        datagrams += 1
+        records += len(batch)
+        delays.extend(time.time() - r[0] for r in batch
+                      if r[1] == recorder.LIDAR and not math.isnan(r[0]))
+        if time.time() >= report:
+            delays.sort()
+            print('%d datagrams/s, %d records/s, %d lost, lidar age p50 '
+                  '%.1f ms' % (datagrams, records, lost,
+                               delays[len(delays) // 2] * 1000
+                               if delays else 0))
+            datagrams = records = lost = 0
+            delays = []
+            report += 1
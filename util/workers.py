@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import resource_tracker
+
+from util.metrics import registry
+from util.shm import RingReader, RingWriter
+
+logger = logging.getLogger(__name__)
+
+##########################################################################
+#  Per bus worker processes
+##########################################################################
+#  Each bus gets its own process, so reads on one bus do not wait for the
+#  GIL behind reads on another, or behind JSON encoding in the command
+#  server. A worker builds its devices in the child, publishes their
+#  samples into shared memory rings (util/shm.py) that the command server
+#  reads without a round trip, and answers other calls over a pipe.
+#
+#    i2c         lidar and BNO055
+#    spi         MCP3008 ADC (IR sensors)
+#    ultrasonic  HC-SR04 echo timing
+#
+#  The proxies below stand in for the devices in the command server. Motion
+#  (stepper, servo, H-bridge) stays in the command server: pigpiod already
+#  does the timing for it, and scans need the stepper and the lidar samples
+#  side by side.
+#
+#  Under the simulator each worker has its own copy of the simulated world
+#  from the moment it was forked, so for instance the lidar in a worker
+#  does not see the roof mount move.
+#
+
+DOMAINS = ('i2c', 'spi', 'ultrasonic')
+
+# ring record layouts:
+LIDAR_RECORD = '<dff'         # timestamp, distance, velocity
+ORIENTATION_RECORD = '<dffffffffffBBBB'
+#   timestamp, heading, roll, pitch, quaternion x, y, z, w, gyro x, y, z,
+#   calibration sys, gyro, accel, mag
+ADC_RECORD = '<dHH'           # timestamp, channel, value
+ULTRASONIC_RECORD = '<dHf'    # timestamp, channel, distance (NaN: none)
+
+_NAN = float('nan')
+
+
+# child side: build the devices, publish their samples, answer calls.
+
+def _build_i2c(config):
+    from lib.lidar import Lidar
+    from lib.orientation import Orientation
+    devices = {}
+    rings = {}
+    lidar = config.get('lidar')
+    if lidar:
+        devices['lidar'] = Lidar(rate=lidar['updateRatePerSecond'],
+                                 buffer_size=lidar.get('bufferSize', 1024),
+                                 block_read=lidar.get('blockRead', True))
+        devices['lidar'].start()
+        rings['lidar'] = LIDAR_RECORD
+    if config.get('orientation'):
+        orientation = dict(config['orientation'], background=True)
+        devices['orientation'] = Orientation(orientation)
+        rings['orientation'] = ORIENTATION_RECORD
+    return devices, rings
+
+
+def _publish_i2c(devices, writers, state):
+    lidar = devices.get('lidar')
+    if lidar is not None:
+        for t, distance, velocity in lidar.since(state.get('lidar', 0)):
+            writers['lidar'].write(t, distance, velocity)
+            state['lidar'] = t
+    orientation = devices.get('orientation')
+    if orientation is not None:
+        latest = orientation.latest()
+        euler = latest.get('euler')
+        if euler is not None and euler is not state.get('euler'):
+            state['euler'] = euler
+            quaternion = latest.get('quaternion', ((_NAN,) * 4, 0))[0]
+            gyro = latest.get('gyro', ((_NAN,) * 3, 0))[0]
+            calibration = latest.get('calibration', ((0,) * 4, 0))[0]
+            writers['orientation'].write(euler[1], *(
+                tuple(euler[0]) + tuple(quaternion) + tuple(gyro) +
+                tuple(calibration)))
+
+
+def _build_spi(config):
+    from lib.adc import ADC
+    adc = ADC(config['adc'])
+    adc.start()
+    return {'adc': adc}, {'adc': ADC_RECORD}
+
+
+def _publish_spi(devices, writers, state):
+    adc = devices['adc']
+    for channel in adc._channels:
+        latest = adc.latest(channel)
+        if latest is not None and latest is not state.get(channel):
+            state[channel] = latest
+            writers['adc'].write(latest[1], channel, latest[0])
+
+
+def _build_ultrasonic(config):
+    from lib.ultrasonic import UltraSonicArray
+    array = UltraSonicArray(config['ultrasonic'])
+    array.start()
+    return {'ultrasonic': array}, {'ultrasonic': ULTRASONIC_RECORD}
+
+
+def _publish_ultrasonic(devices, writers, state):
+    array = devices['ultrasonic']
+    for channel, name in enumerate(sorted(array._sensors)):
+        latest = array.latest(name)
+        if latest is not None and latest is not state.get(name):
+            state[name] = latest
+            distance, t = latest
+            writers['ultrasonic'].write(
+                t, channel, _NAN if distance is None else distance)
+
+
+_DOMAINS = {
+    'i2c': (_build_i2c, _publish_i2c),
+    'spi': (_build_spi, _publish_spi),
+    'ultrasonic': (_build_ultrasonic, _publish_ultrasonic),
+}
+
+
+def _serve(domain, config, prefix, conn, rate):
+    build, publish = _DOMAINS[domain]
+    try:
+        devices, formats = build(config)
+        writers = {key: RingWriter(prefix + key, fmt)
+                   for key, fmt in formats.items()}
+    except Exception as e:
+        conn.send(('error', '%s: %s' % (type(e).__name__, e)))
+        return
+    conn.send(('ready', sorted(writers)))
+    running = [True]
+
+    def publisher():
+        period = 1.0 / rate
+        state = {}
+        while running[0]:
+            try:
+                publish(devices, writers, state)
+            except OSError as e:
+                logger.warning('%s worker publish failed: %s', domain, e)
+            time.sleep(period)
+    thread = threading.Thread(target=publisher, daemon=True)
+    thread.start()
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break  # the command server went away
+        if request is None:
+            break
+        device, method, args = request
+        try:
+            if device is None and method == 'stats':
+                result = registry.snapshot()
+            else:
+                result = getattr(devices[device], method)(*args)
+            conn.send((True, result))
+        except Exception as e:
+            conn.send((False, '%s: %s' % (type(e).__name__, e)))
+    running[0] = False
+    thread.join()
+    for device in devices.values():
+        if hasattr(device, 'stop'):
+            device.stop()
+    for writer in writers.values():
+        writer.close()
+
+
+# command server side:
+
+class Worker:
+    '''A bus domain running in a child process'''
+
+    def __init__(self, domain, config, rate=500):
+        self.domain = domain
+        self._prefix = 'hal%d_%s_' % (os.getpid(), domain)
+        self._conn, child = multiprocessing.Pipe()
+        self._lock = threading.Lock()
+        # the child's rings are tracked by the tracker we share with it:
+        resource_tracker.ensure_running()
+        self._process = multiprocessing.Process(
+            target=_serve, name='hal-' + domain,
+            args=(domain, config, self._prefix, child, rate), daemon=True)
+        self._process.start()
+        status, detail = self._conn.recv()
+        if status != 'ready':
+            self._process.join()
+            raise RuntimeError('%s worker failed to start: %s'
+                               % (domain, detail))
+        self._rings = {key: RingReader(self._prefix + key, forked=True)
+                       for key in detail}
+        registry.gauge('worker.' + domain, self.stats)
+        logger.info('Started %s worker, pid %d', domain, self._process.pid)
+
+    def ring(self, key):
+        return self._rings[key]
+
+    def call(self, device, method, *args):
+        with self._lock:
+            self._conn.send((device, method, args))
+            ok, result = self._conn.recv()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def stats(self):
+        '''The worker's own metrics'''
+        return self.call(None, 'stats')
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+        self._process.join(5)
+        for ring in self._rings.values():
+            ring.close()
+
+
+def _newest(ring, match, limit):
+    '''Newest record in ring for which match(record) is true, looking at
+    no more than limit records'''
+    count = ring.count()
+    for n in range(count - 1, max(-1, count - 1 - limit), -1):
+        record = ring.read(n)
+        if record is not None and match(record):
+            return record
+    return None
+
+
+class LidarProxy:
+    '''The Lidar interface over an i2c worker. The worker always samples
+    in the background.'''
+
+    def __init__(self, worker, rate):
+        self._worker = worker
+        self._ring = worker.ring('lidar')
+        self.rate = rate
+
+    def running(self):
+        return True
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read(self):
+        return self._worker.call('lidar', 'read')
+
+    def latest(self):
+        return self._ring.latest()
+
+    def since(self, t):
+        ring = self._ring
+        count = ring.count()
+        samples = []
+        for n in range(count - 1, max(-1, count - 1 - ring.capacity), -1):
+            sample = ring.read(n)
+            if sample is None:
+                continue  # being rewritten
+            if sample[0] <= t:
+                break
+            samples.append(sample)
+        samples.reverse()
+        return samples
+
+
+class OrientationProxy:
+
+    def __init__(self, worker):
+        self._worker = worker
+        self._ring = worker.ring('orientation')
+
+    def running(self):
+        return True
+
+    def latest(self):
+        record = self._ring.latest()
+        if record is None:
+            return {}
+        t = record[0]
+        return {
+            'euler': (record[1:4], t),
+            'quaternion': (record[4:8], t),
+            'gyro': (record[8:11], t),
+            'calibration': (record[11:15], t),
+        }
+
+    def euler(self):
+        record = self._ring.latest()
+        return record[1:4] if record is not None else (0.0, 0.0, 0.0)
+
+    def read(self):
+        return self._worker.call('orientation', 'read')
+
+
+class ADCProxy:
+
+    def __init__(self, worker, channels):
+        self._worker = worker
+        self._ring = worker.ring('adc')
+        self._channels = list(channels)
+
+    def running(self):
+        return True
+
+    def read(self, channel):
+        return self._worker.call('adc', 'read', channel)
+
+    def latest(self, channel):
+        record = _newest(self._ring, lambda r: r[1] == channel,
+                         4 * len(self._channels))
+        return None if record is None else (record[2], record[0])
+
+
+class UltraSonicProxy:
+
+    def __init__(self, worker, sensors):
+        self._worker = worker
+        self._ring = worker.ring('ultrasonic')
+        self._sensors = sensors
+        self._channels = {name: channel
+                          for channel, name in enumerate(sorted(sensors))}
+
+    def running(self):
+        return True
+
+    def ping(self, name):
+        return self._worker.call('ultrasonic', 'ping', name)
+
+    def latest(self, name):
+        channel = self._channels[name]
+        record = _newest(self._ring, lambda r: r[1] == channel,
+                         4 * len(self._channels))
+        if record is None:
+            return None
+        distance = None if math.isnan(record[2]) else record[2]
+        return distance, record[0]